@@ -1,11 +1,257 @@
+import re
 import json
+import asyncio
 import logging
-from typing import List, Dict, Optional
+import time
+import math
+from collections import deque, OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import List, Dict, Optional, Callable, Awaitable, NamedTuple
 import aiohttp
 import config
+from models import Participant, ParticipantMessage, ConversationTurn
 
 logger = logging.getLogger(__name__)
 
+# В порядке приоритета: основной, запасной
+PROVIDERS = ("groq", "openrouter")
+
+# Классы приоритета запросов: ответ в чате важнее фоновой проверки победителя
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+def count_tokens(text: str) -> int:
+    """Грубая оценка токенов текста: ~3 символа (кириллица) на токен плюс служебные токены сообщения"""
+    return len(text) // 3 + 4
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Оценка токенов промпта"""
+    return sum(count_tokens(m["content"]) for m in messages)
+
+# Служебная метка оценки хода в конце ответа: [[СИМПАТИЯ:+2]]
+AFFECTION_TAG = re.compile(r"\[\[\s*СИМПАТИЯ\s*:\s*([+-]?\d+)\s*\]\]", re.IGNORECASE)
+
+def parse_affection(text: str) -> Optional[int]:
+    """Оценка хода из метки в ответе (последняя метка, в пределах лимита) или None"""
+    found = AFFECTION_TAG.findall(text)
+    if not found:
+        return None
+    limit = config.AFFECTION_DELTA_LIMIT
+    return max(-limit, min(limit, int(found[-1])))
+
+class AIReply(NamedTuple):
+    """Ответ Алисы и оценка хода автора сообщения (None - оценки нет)"""
+    text: str
+    affection: Optional[int] = None
+
+class ProviderUnavailable(Exception):
+    """Провайдер пропущен: предохранитель разомкнут"""
+
+class CircuitBreaker:
+    """Предохранитель провайдера: closed -> open (пауза) -> half-open (один пробный запрос) -> closed"""
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.outcomes = deque(maxlen=20)  # (время, успех) последних запросов
+
+    def available(self) -> bool:
+        if self.state == "open":
+            return time.monotonic() >= self.open_until
+        return not (self.state == "half_open" and self.probe_in_flight)
+
+    def acquire(self) -> bool:
+        """Можно ли отправить запрос сейчас (в half-open пропускает только один)"""
+        if not self.available():
+            return False
+        if self.state == "open":
+            self.state = "half_open"
+        if self.state == "half_open":
+            self.probe_in_flight = True
+        return True
+
+    def release(self):
+        """Запрос отменен без результата"""
+        self.probe_in_flight = False
+
+    def record_success(self):
+        self.outcomes.append((time.monotonic(), True))
+        self.state = "closed"
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self, retry_after: Optional[float] = None):
+        self.outcomes.append((time.monotonic(), False))
+        self.failures += 1
+        self.probe_in_flight = False
+        # Явный Retry-After и проваленная проба размыкают сразу
+        if retry_after is not None or self.state == "half_open" or self.failures >= config.AI_BREAKER_FAILURES:
+            cooldown = config.AI_BREAKER_COOLDOWN if retry_after is None else retry_after
+            self.state = "open"
+            self.open_until = time.monotonic() + min(cooldown, config.AI_BREAKER_MAX_COOLDOWN)
+
+    def record_rejected(self):
+        """Отказ без перегрузки (400/401/403...): портит здоровье, но предохранитель не размыкает"""
+        self.outcomes.append((time.monotonic(), False))
+        self.probe_in_flight = False
+
+    def retry_in(self) -> float:
+        return max(self.open_until - time.monotonic(), 0.0)
+
+    def success_rate(self) -> float:
+        # Старые неудачи забываются, иначе восстановившийся провайдер навсегда остается запасным
+        since = time.monotonic() - config.AI_HEALTH_WINDOW
+        recent = [ok for at, ok in self.outcomes if at >= since]
+        return sum(recent) / len(recent) if recent else 1.0
+
+def _retry_after(headers) -> Optional[float]:
+    """Retry-After в секундах (число или HTTP-дата)"""
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Ведро токенов с пополнением per_minute в минуту"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: int) -> float:
+        """Через сколько секунд хватит amount (запрос больше емкости ждет полного ведра)"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: int):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount: int):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+class LLMScheduler:
+    """Допуск запросов к одному провайдеру: лимиты RPM/TPM, приоритеты и очередь по чатам.
+
+    Пока есть ожидающие интерактивные запросы, фоновые не допускаются. Внутри
+    класса приоритета чаты обслуживаются по кругу, поэтому шумная группа не
+    забирает весь лимит.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # {приоритет: {chat_id: deque[(future, tokens)]}}, порядок ключей - очередь обхода чатов
+        self._queues = {PRIORITY_INTERACTIVE: OrderedDict(), PRIORITY_BACKGROUND: OrderedDict()}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.granted = 0
+        self.timeouts = 0
+
+    async def acquire(self, tokens: int, priority: int, chat_id: Optional[int]) -> bool:
+        """Дождаться допуска. False - не дождались за AI_QUEUE_MAX_WAIT"""
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(chat_id, deque()).append((future, tokens))
+        self._dispatch()
+        try:
+            # Отмененный future пропускается при раздаче
+            await asyncio.wait_for(future, config.AI_QUEUE_MAX_WAIT)
+            return True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+
+    def settle(self, reserved: int, used: int = 0):
+        """Вернуть в ведро токены, зарезервированные сверх фактического расхода
+        (used=0 - запрос не дошел до модели, резерв возвращается целиком)"""
+        if used < reserved:
+            self.tokens.give_back(reserved - used)
+            # Ожидающие могут воспользоваться возвратом сразу, а не по старому таймеру
+            self._dispatch()
+
+    def queued(self) -> int:
+        # Истекшие и отмененные ожидания лежат в очереди до следующей раздачи
+        return sum(
+            1 for chats in self._queues.values() for waiting in chats.values()
+            for future, _ in waiting if not future.done()
+        )
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            while chats:
+                chat_id, waiting = next(iter(chats.items()))
+                future, tokens = waiting[0]
+                if future.done():
+                    self._pop(chats, chat_id, rotate=False)
+                    continue
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait > 0:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                    return
+                self.requests.take(1)
+                self.tokens.take(tokens)
+                self.granted += 1
+                future.set_result(None)
+                self._pop(chats, chat_id, rotate=True)
+            # Нижний приоритет только когда верхний пуст
+
+    @staticmethod
+    def _pop(chats: OrderedDict, chat_id: Optional[int], rotate: bool):
+        waiting = chats[chat_id]
+        waiting.popleft()
+        if not waiting:
+            del chats[chat_id]
+        elif rotate:
+            chats.move_to_end(chat_id)
+
+class ProviderStats:
+    """Задержки и переиспользование соединений одного провайдера"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.latencies = deque(maxlen=200)  # Секунды последних запросов
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def summary(self) -> Dict:
+        connections = self.new_connections + self.reused_connections
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_rate': round(self.reused_connections / connections, 2) if connections else 0.0,
+            'p50_ms': round(p50 * 1000) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000) if p95 is not None else None
+        }
+
 class AIHandler:
     def __init__(self):
         # Настройки Groq (основной)
@@ -18,6 +264,23 @@ class AIHandler:
         self.or_model = config.OPENROUTER_AI_MODEL
         self.or_url = config.OPENROUTER_API_URL
         
+        # Долгоживущие HTTP-сессии: DNS, TCP и TLS не повторяются на каждый запрос
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self.stats = {provider: ProviderStats() for provider in PROVIDERS}
+        self.breakers = {provider: CircuitBreaker() for provider in PROVIDERS}
+        self.schedulers = {
+            provider: LLMScheduler(config.AI_RATE_LIMITS[provider]["rpm"], config.AI_RATE_LIMITS[provider]["tpm"])
+            for provider in PROVIDERS
+        }
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'primary_wins': 0, 'secondary_wins': 0}
+        # Краткое содержание старой части разговора: {chat_id: (текст, последняя свернутая реплика)}
+        self._summaries: Dict[int, tuple] = {}
+        # Выпавшие из контекста реплики, ждущие свертки, и фоновые задачи свертки
+        self._summary_pending: Dict[int, List[ConversationTurn]] = {}
+        self._summary_tasks: Dict[int, asyncio.Task] = {}
+        # Последний вердикт decide_winner: {chat_id: (отпечаток входных данных, решение)}
+        self._verdicts: Dict[int, tuple] = {}
+        
         # --- ФОРМИРОВАНИЕ ПРАВИЛ НА ОСНОВЕ CONFIG ---
         
         # Правило возраста (общее для всех)
@@ -111,8 +374,93 @@ class AIHandler:
 - Когда влюбишься - скажи прямо: "Всё, {{имя}}, я в тебя влюбилась. Хочу быть с тобой ❤️"
 """
 
-    async def _make_request(self, messages: List[Dict], temp: float, provider: str) -> tuple[int, Dict]:
-        """Внутренний метод для запроса"""
+        # Служебная оценка хода для счета симпатии (из ответа вырезается)
+        limit = config.AFFECTION_DELTA_LIMIT
+        self.affection_rule = f"""
+
+ОЦЕНКА ХОДА (СЛУЖЕБНОЕ):
+В самом конце каждого ответа добавь метку [[СИМПАТИЯ:N]], где N - насколько последнее сообщение собеседника изменило твою симпатию к нему: от -{limit} (бесит) до +{limit} (реально зацепил), 0 - ничего не изменилось. Метку видишь только ты, никогда ее не упоминай."""
+
+    async def start(self):
+        """Открыть HTTP-сессии провайдеров (при старте бота)"""
+        for provider in self.stats:
+            self._session(provider)
+
+    async def close(self):
+        """Закрыть HTTP-сессии (при остановке бота)"""
+        for task in self._summary_tasks.values():
+            task.cancel()
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def http_stats(self) -> Dict:
+        """Задержки и доля переиспользованных соединений по провайдерам"""
+        return {
+            provider: {
+                **stats.summary(),
+                'circuit': self.breakers[provider].state,
+                'success_rate': round(self.breakers[provider].success_rate(), 2),
+                'queued': self.schedulers[provider].queued(),
+                'granted': self.schedulers[provider].granted,
+                'queue_timeouts': self.schedulers[provider].timeouts
+            }
+            for provider, stats in self.stats.items()
+        }
+
+    def _ranked_providers(self) -> List[str]:
+        """Провайдеры по здоровью: доступные, с большей долей успехов, затем более быстрые.
+
+        При равенстве сохраняется порядок PROVIDERS; провайдер без замеров не обгоняет известный.
+        """
+        def health(provider: str):
+            breaker = self.breakers[provider]
+            p50 = self.stats[provider].percentile(0.5)
+            return (not breaker.available(), -round(breaker.success_rate(), 1), p50 if p50 is not None else math.inf)
+        return sorted(PROVIDERS, key=health)
+
+    def hedge_summary(self) -> Dict:
+        """Доля запросов с подстраховкой и кто из провайдеров выигрывал гонку"""
+        stats = self.hedge_stats
+        hedged = stats['hedged']
+        return {
+            **stats,
+            'hedge_rate': round(hedged / stats['requests'], 2) if stats['requests'] else 0.0,
+            'secondary_win_rate': round(stats['secondary_wins'] / hedged, 2) if hedged else 0.0
+        }
+
+    def _session(self, provider: str) -> aiohttp.ClientSession:
+        # Создается лениво, если start() не вызывался
+        session = self._sessions.get(provider)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.AI_HTTP_MAX_CONNECTIONS,
+                ttl_dns_cache=config.AI_HTTP_DNS_TTL,
+                keepalive_timeout=config.AI_HTTP_KEEPALIVE
+            )
+            session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config(provider)])
+            self._sessions[provider] = session
+        return session
+
+    def _trace_config(self, provider: str) -> aiohttp.TraceConfig:
+        stats = self.stats[provider]
+
+        async def on_connection_create_end(session, ctx, params):
+            stats.new_connections += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            stats.reused_connections += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def _make_request(self, messages: List[Dict], temp: float, provider: str,
+                            priority: int = PRIORITY_INTERACTIVE, chat_id: Optional[int] = None,
+                            on_delta: Optional[Callable[[str], Awaitable]] = None,
+                            max_tokens: Optional[int] = None) -> tuple[int, Dict]:
+        """Внутренний метод для запроса (с on_delta - потоковый, результат в той же форме)"""
         if provider == "groq":
             url = self.groq_url
             key = self.groq_api_key
@@ -122,28 +470,303 @@ class AIHandler:
             key = self.or_api_key
             model = self.or_model
 
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Authorization": f"Bearer {key}",
-                "Content-Type": "application/json"
-            }
-            if provider == "openrouter":
-                 headers["HTTP-Referer"] = config.RENDER_APP_URL or "http://localhost"
-            
-            data = {
-                "model": model,
-                "messages": messages,
-                "temperature": temp,
-                "max_tokens": config.AI_MAX_TOKENS,
-                "top_p": 0.95
-            }
-            
-            async with session.post(url, headers=headers, json=data) as response:
-                return response.status, await response.json() if response.status == 200 else await response.text()
+        headers = {
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json"
+        }
+        if provider == "openrouter":
+             headers["HTTP-Referer"] = config.RENDER_APP_URL or "http://localhost"
+        
+        max_tokens = max_tokens or config.AI_MAX_TOKENS
+        data = {
+            "model": model,
+            "messages": messages,
+            "temperature": temp,
+            "max_tokens": max_tokens,
+            "top_p": 0.95
+        }
+        if on_delta:
+            data["stream"] = True
+            # Без этого usage в потоке не приходит и резерв токенов не возвращается
+            data["stream_options"] = {"include_usage": True}
+        
+        breaker = self.breakers[provider]
+        if not breaker.acquire():
+            raise ProviderUnavailable(f"{provider} circuit open, retry in {breaker.retry_in():.0f}s")
+        
+        stats = self.stats[provider]
+        scheduler = self.schedulers[provider]
+        # Резерв на худший случай: промпт + весь лимит ответа, лишнее возвращается по usage
+        reserved = estimate_tokens(messages) + max_tokens
+        started = None
+        try:
+            if not await scheduler.acquire(reserved, priority, chat_id):
+                breaker.release()
+                raise ProviderUnavailable(f"{provider} request queue wait exceeded {config.AI_QUEUE_MAX_WAIT}s")
+            # Дальше резерв взят: на любом пути без ответа 200 он возвращается
+            started = time.monotonic()
+            async with self._session(provider).post(url, headers=headers, json=data) as response:
+                if response.status == 200 and on_delta:
+                    result = await self._read_stream(response, on_delta)
+                else:
+                    result = await response.json() if response.status == 200 else await response.text()
+        except asyncio.CancelledError:
+            # Проигравший hedged-запрос: время до отмены - нижняя оценка задержки, без нее p95 занижается
+            if started is not None:
+                stats.latencies.append(time.monotonic() - started)
+                scheduler.settle(reserved)
+            breaker.release()
+            raise
+        except ProviderUnavailable:
+            raise
+        except Exception:
+            if started is not None:
+                scheduler.settle(reserved)
+            breaker.record_failure()
+            raise
+        if response.status == 200 and isinstance(result, dict):
+            usage = result.get("usage")
+            if usage:
+                scheduler.settle(reserved, usage.get("total_tokens", reserved))
+            elif on_delta:
+                # Провайдер не прислал usage в потоке: оцениваем по промпту и полученному тексту
+                content = result["choices"][0]["message"]["content"]
+                scheduler.settle(reserved, estimate_tokens(messages) + count_tokens(content))
+        else:
+            # Отказ провайдера (4xx/5xx): токены модели не тратились
+            scheduler.settle(reserved)
+        stats.requests += 1
+        # Быстрые отказы не должны делать провайдер "самым быстрым" при ранжировании
+        if response.status == 200:
+            stats.latencies.append(time.monotonic() - started)
+        
+        if response.status == 200:
+            breaker.record_success()
+        elif response.status == 429 or response.status >= 500:
+            breaker.record_failure(_retry_after(response.headers))
+        else:
+            breaker.record_rejected()
+        return response.status, result
+
+    async def _read_stream(self, response: aiohttp.ClientResponse, on_delta: Callable[[str], Awaitable]) -> Dict:
+        """Читает SSE-поток chat completions и передает в on_delta накопленный текст"""
+        parts = []
+        usage = None
+        async for raw in response.content:
+            line = raw.decode("utf-8").strip()
+            # Пустые строки и комментарии (": OPENROUTER PROCESSING") пропускаем
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            if chunk.get("error"):
+                raise RuntimeError(f"Stream error: {chunk['error']}")
+            usage = chunk.get("usage") or usage
+            choices = chunk.get("choices") or []
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if delta:
+                parts.append(delta)
+                await on_delta(self._clean_reply("".join(parts)))
+        # В той же форме, что и обычный ответ
+        return {"choices": [{"message": {"content": "".join(parts)}}], "usage": usage}
+
+    @staticmethod
+    def _clean_reply(text: str) -> str:
+        text = AFFECTION_TAG.sub("", text)
+        # Недописанная метка в конце потока тоже не должна мелькать в чате
+        partial = text.rfind("[[")
+        if partial != -1 and "]]" not in text[partial:]:
+            text = text[:partial]
+        text = text.rstrip("[").strip()
+        if text.startswith(f"{config.BOT_NAME}:"):
+            text = text[len(config.BOT_NAME)+1:].strip()
+        return text
+
+    async def _sequential_request(self, messages: List[Dict], temp: float, chat_id: Optional[int],
+                                  on_delta: Optional[Callable[[str], Awaitable]] = None) -> List[tuple]:
+        """Провайдеры по очереди до первого успешного ответа. Возвращает [(provider, status, result)]"""
+        outcomes = []
+        for provider in self._ranked_providers():
+            try:
+                status, result = await self._make_request(messages, temp, provider, chat_id=chat_id, on_delta=on_delta)
+            except Exception as e:
+                status, result = None, e
+            outcomes.append((provider, status, result))
+            if status == 200:
+                break
+        return outcomes
+
+    async def _hedged_request(self, messages: List[Dict], temp: float, difficulty: str, chat_id: Optional[int]) -> List[tuple]:
+        """Запрос к основному провайдеру с подстраховкой запасным.
+
+        Если основной не ответил за порог, тот же запрос уходит запасному. Побеждает
+        первый успешный ответ, второй запрос отменяется. Если основной быстро
+        отказал, запасной спрашивается сразу, как при обычном переключении.
+        """
+        primary, secondary = self._ranked_providers()
+        delay = self._hedge_delay(primary, difficulty)
+        self.hedge_stats['requests'] += 1
+        pending = {asyncio.create_task(self._make_request(messages, temp, primary, chat_id=chat_id)): primary}
+        secondary_started = hedged = False
+        outcomes = []
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=None if secondary_started else delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = secondary_started = True
+                    self.hedge_stats['hedged'] += 1
+                    pending[asyncio.create_task(self._make_request(messages, temp, secondary, chat_id=chat_id))] = secondary
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    try:
+                        status, result = task.result()
+                    except Exception as e:
+                        status, result = None, e
+                    outcomes.append((provider, status, result))
+                    if status == 200:
+                        if hedged:
+                            self.hedge_stats['primary_wins' if provider == primary else 'secondary_wins'] += 1
+                        return outcomes
+                if not secondary_started:
+                    secondary_started = True
+                    pending[asyncio.create_task(self._make_request(messages, temp, secondary, chat_id=chat_id))] = secondary
+        finally:
+            for task in pending:
+                task.cancel()
+        return outcomes
 
-    async def get_response(self, message: str, conversation_history: List[Dict], 
+    def _hedge_delay(self, provider: str, difficulty: str) -> float:
+        delay = config.AI_HEDGE_DELAYS.get(difficulty, config.AI_HEDGE_DELAYS["hard"])
+        stats = self.stats[provider]
+        if config.AI_HEDGE_ADAPTIVE and len(stats.latencies) >= config.AI_HEDGE_MIN_SAMPLES:
+            delay = stats.percentile(0.95)
+        return delay
+
+    def reset_context(self, chat_id: int):
+        """Забыть краткое содержание разговора и вердикт (новая игра в чате)"""
+        self._summaries.pop(chat_id, None)
+        self._verdicts.pop(chat_id, None)
+        self._summary_pending.pop(chat_id, None)
+        task = self._summary_tasks.pop(chat_id, None)
+        if task:
+            task.cancel()
+
+    def _build_context(self, history: List[ConversationTurn], difficulty: str,
+                       chat_id: Optional[int]) -> tuple[Optional[str], List[ConversationTurn]]:
+        """Упаковывает историю в бюджет токенов сложности.
+
+        Свежие реплики идут в промпт как есть, пока влезают в бюджет; то, что
+        старше, сворачивается в краткое содержание. Возвращает (краткое
+        содержание или None, свежие реплики).
+        """
+        summary = self._summaries.get(chat_id, (None, None))[0] if chat_id is not None else None
+        budget = config.AI_CONTEXT_BUDGETS.get(difficulty, config.AI_CONTEXT_BUDGETS["hard"])
+        if summary:
+            budget -= count_tokens(summary)
+        # На пару реплик меньше окна: каждая реплика успевает попасть в свертку до вытеснения из окна
+        max_turns = max(config.CONVERSATION_WINDOW - 2, 1)
+        recent = []
+        for turn in reversed(history):
+            cost = count_tokens(turn.content)
+            if len(recent) >= max_turns or cost > budget:
+                break
+            budget -= cost
+            recent.append(turn)
+        recent.reverse()
+        if chat_id is not None:
+            self._queue_summary(chat_id, history, len(history) - len(recent))
+        return summary, recent
+
+    def _queue_summary(self, chat_id: int, history: List[ConversationTurn], older_count: int):
+        """Ставит в очередь свертки еще не свернутые реплики из history[:older_count]"""
+        pending = self._summary_pending.setdefault(chat_id, [])
+        last_folded = pending[-1] if pending else self._summaries.get(chat_id, (None, None))[1]
+        # Если последней свернутой реплики уже нет в окне, все старые реплики новее нее
+        start = history.index(last_folded) + 1 if last_folded in history else 0
+        pending.extend(history[start:older_count])
+        # Если свертка раз за разом не удается, очередь не растет бесконечно
+        del pending[:-config.AI_SUMMARY_BATCH * 4]
+        if len(pending) >= config.AI_SUMMARY_BATCH and chat_id not in self._summary_tasks:
+            self._summary_tasks[chat_id] = asyncio.create_task(self._refresh_summary(chat_id))
+
+    async def _refresh_summary(self, chat_id: int):
+        """Фоновая свертка накопленных реплик в краткое содержание"""
+        try:
+            turns = list(self._summary_pending.get(chat_id, []))
+            summary = self._summaries.get(chat_id, (None, None))[0]
+            text = await self._summarize(summary, turns, chat_id)
+            if text:
+                self._summaries[chat_id] = (text, turns[-1])
+                del self._summary_pending.get(chat_id, [])[:len(turns)]
+        finally:
+            if self._summary_tasks.get(chat_id) is asyncio.current_task():
+                del self._summary_tasks[chat_id]
+
+    async def _summarize(self, summary: Optional[str], turns: List[ConversationTurn], chat_id: int) -> Optional[str]:
+        """Обновляет краткое содержание новыми репликами (фоновый приоритет)"""
+        # Реплики пользователей уже в виде "Имя: текст"
+        lines = "\n".join(
+            f"{config.BOT_NAME}: {t.content}" if t.role == "assistant" else t.content for t in turns
+        )
+        prompt_text = f"""Текущее краткое содержание:
+{summary or "(пока пусто)"}
+
+Новые реплики:
+{lines}
+
+Обнови краткое содержание: 3-6 коротких предложений. Сохрани, кто из участников как себя вел и как к нему относится {config.BOT_NAME}, важные факты и удачные шутки. Без вступлений."""
+        messages = [
+            {"role": "system", "content": f"Ты ведешь краткий конспект переписки в групповом чате, где {config.BOT_NAME} общается с участниками игры."},
+            {"role": "user", "content": prompt_text}
+        ]
+        for provider in self._ranked_providers():
+            try:
+                status, result = await self._make_request(
+                    messages, 0.3, provider, PRIORITY_BACKGROUND, chat_id, max_tokens=config.AI_SUMMARY_MAX_TOKENS
+                )
+                if status == 200:
+                    return result["choices"][0]["message"]["content"].strip()
+            except ProviderUnavailable as e:
+                logger.info(str(e))
+            except Exception as e:
+                logger.error(f"Summary error with {provider}: {e}")
+        return None
+
+    @staticmethod
+    def _fit_texts(texts: List[str], budget: int) -> List[str]:
+        """Самые свежие тексты, влезающие в бюджет токенов (в хронологическом порядке)"""
+        fitted = []
+        for text in reversed(texts):
+            cost = count_tokens(text)
+            if cost > budget:
+                # Единственное длинное сообщение обрезаем, а не выбрасываем
+                if not fitted:
+                    fitted.append(text[:max(budget - 4, 0) * 3] + "…")
+                break
+            budget -= cost
+            fitted.append(text)
+        fitted.reverse()
+        return fitted
+
+    @staticmethod
+    def format_user_message(user_name: str, user_messages_count: int, message: str) -> str:
+        return f"{user_name} (сообщение #{user_messages_count}): {message}"
+
+    async def get_response(self, message: str, conversation_history: List[ConversationTurn], 
                           user_name: str, user_messages_count: int,
-                          all_participants: List[Dict], difficulty: str = "hard") -> str:
+                          all_participants: List[Participant], difficulty: str = "hard",
+                          chat_id: Optional[int] = None,
+                          on_delta: Optional[Callable[[str], Awaitable]] = None,
+                          queued: Optional[List[str]] = None) -> AIReply:
+        """Ответ Алисы. С on_delta ответ запрашивается потоком, и on_delta получает
+        накопленный текст по мере генерации; возвращается все равно полный текст.
+        queued - сообщения (через format_user_message), пришедшие перед message,
+        пока готовился прошлый ответ: Алиса отвечает на все разом."""
         
         # Выбор промпта
         if difficulty == "easy":
@@ -155,34 +778,54 @@ class AIHandler:
 
         messages = [{"role": "system", "content": system_prompt}]
         
-        # Добавляем историю
-        for msg in conversation_history[-15:]:
-            messages.append({"role": msg["role"], "content": msg["content"]})
+        # Добавляем историю: свежие реплики в бюджете токенов, старые - кратким содержанием
+        summary, recent = self._build_context(conversation_history, difficulty, chat_id)
+        if summary:
+            messages[0]["content"] += f"\n\n[РАНЕЕ В РАЗГОВОРЕ: {summary}]"
+        for msg in recent:
+            messages.append({"role": msg.role, "content": msg.content})
         
         # Инфо об участниках
         if all_participants:
             participants_info = f"\n\n[УЧАСТНИКИ: {len(all_participants)} чел. "
             for p in all_participants[:3]:
-                participants_info += f"{p['first_name']} (@{p['username']}) - {p['message_count']} сообщ., "
+                participants_info += f"{p.first_name} (@{p.username}) - {p.message_count} сообщ., "
             participants_info += "]"
             messages[0]["content"] += participants_info
         
-        user_context = f"{user_name} (сообщение #{user_messages_count}): {message}"
+        if config.AI_AFFECTION_SCORING:
+            messages[0]["content"] += self.affection_rule
+        
+        if queued:
+            messages[0]["content"] += "\n\n[Пока ты отвечала, пришло несколько сообщений подряд - ответь на них одним сообщением]"
+            for text in queued:
+                messages.append({"role": "user", "content": text})
+        
+        user_context = self.format_user_message(user_name, user_messages_count, message)
         messages.append({"role": "user", "content": user_context})
 
         # --- ЛОГИКА ПЕРЕКЛЮЧЕНИЯ API ---
-        providers = ["groq", "openrouter"]
+        # Два потока наперегонки не могут писать в одно сообщение, поэтому стриминг без hedging
+        if config.AI_HEDGING and on_delta is None:
+            outcomes = await self._hedged_request(messages, config.AI_TEMPERATURE, difficulty, chat_id)
+        else:
+            outcomes = await self._sequential_request(messages, config.AI_TEMPERATURE, chat_id, on_delta)
         last_error = ""
 
-        for provider in providers:
+        for provider, status, result in outcomes:
             try:
-                status, result = await self._make_request(messages, config.AI_TEMPERATURE, provider)
+                if isinstance(result, ProviderUnavailable):
+                    # Пропуск без запроса: провайдер на паузе
+                    logger.info(str(result))
+                    last_error = str(result)
+                    continue
+                if status is None:
+                    raise result
                 
                 if status == 200:
-                    ai_response = result["choices"][0]["message"]["content"].strip()
-                    if ai_response.startswith(f"{config.BOT_NAME}:"):
-                        ai_response = ai_response[len(config.BOT_NAME)+1:].strip()
-                    return ai_response
+                    content = result["choices"][0]["message"]["content"]
+                    affection = parse_affection(content) if config.AI_AFFECTION_SCORING else None
+                    return AIReply(self._clean_reply(content), affection)
                 
                 # Обработка ошибок лимитов (429) или других
                 logger.warning(f"Provider {provider} failed with status {status}. Response: {result}")
@@ -201,13 +844,24 @@ class AIHandler:
 
         # Если все провайдеры отказали
         if "429" in str(last_error) or "limit" in str(last_error).lower():
-            return "SYSTEM_OVERLOAD_LIMITS" # Специальный код для main.py чтобы завершить игру
+            return AIReply("SYSTEM_OVERLOAD_LIMITS") # Специальный код для main.py чтобы завершить игру
         
-        return "Блять, че-то у меня технические проблемы... попробуй позже 😤"
+        return AIReply("Блять, че-то у меня технические проблемы... попробуй позже 😤")
+
+    async def decide_winner(self, all_participants: List[Participant], 
+                           participant_messages: List[ParticipantMessage], difficulty: str = "hard",
+                           chat_id: Optional[int] = None) -> Optional[Dict]:
+        """AI решает кто победил (в кого влюбилась).
+
+        Вердикт кэшируется по чату: если с прошлой проверки участники и их
+        сообщения не изменились, повторный запрос к AI не делается.
+        """
+        fingerprint = hash((difficulty, tuple(all_participants), tuple(participant_messages)))
+        cached = self._verdicts.get(chat_id)
+        if cached and cached[0] == fingerprint:
+            logger.debug(f"Winner decision for chat {chat_id} reused: nothing changed")
+            return cached[1]
 
-    async def decide_winner(self, all_participants: List[Dict], 
-                           participant_messages: List[Dict], difficulty: str = "hard") -> Optional[Dict]:
-        """AI решает кто победил (в кого влюбилась)"""
         if difficulty == "easy":
             system_prompt = self.prompt_easy
         elif difficulty == "medium":
@@ -216,15 +870,18 @@ class AIHandler:
             system_prompt = self.prompt_hard
 
         participants_summary = []
+        # Бюджет токенов на сообщения делится поровну между участниками
+        share = config.AI_WINNER_BUDGET // max(len(all_participants), 1)
         for participant in all_participants:
-            user_id = participant['user_id']
-            messages = [m for m in participant_messages if m['user_id'] == user_id]
-            messages_text = "\n".join([f"- {m['message']}" for m in messages[-5:]])
+            user_id = participant.user_id
+            messages = [m.message for m in participant_messages if m.user_id == user_id]
+            fitted = self._fit_texts(messages[-config.WINNER_MESSAGES_PER_USER:], share)
+            messages_text = "\n".join([f"- {text}" for text in fitted])
             participants_summary.append({
                 'user_id': user_id,
-                'name': participant['first_name'],
-                'username': participant['username'],
-                'count': participant['message_count'],
+                'name': participant.first_name,
+                'username': participant.username,
+                'count': participant.message_count,
                 'messages': messages_text
             })
         
@@ -259,16 +916,22 @@ class AIHandler:
         ]
 
         # Fallback логика для winner
-        providers = ["groq", "openrouter"]
-        for provider in providers:
+        for provider in self._ranked_providers():
             try:
-                status, result = await self._make_request(messages, 0.7, provider)
+                status, result = await self._make_request(messages, 0.7, provider, PRIORITY_BACKGROUND, chat_id)
                 if status == 200:
                     ai_response = result["choices"][0]["message"]["content"].strip()
                     start_idx = ai_response.find('{')
                     end_idx = ai_response.rfind('}') + 1
                     if start_idx != -1:
-                        return json.loads(ai_response[start_idx:end_idx])
+                        decision = json.loads(ai_response[start_idx:end_idx])
+                        # Неудачи не кэшируем: следующая проверка спросит снова
+                        if chat_id is not None:
+                            self._verdicts[chat_id] = (fingerprint, decision)
+                        return decision
+            except ProviderUnavailable as e:
+                logger.info(str(e))
+                continue
             except Exception as e:
                 logger.error(f"Decide winner error with {provider}: {e}")
                 continue
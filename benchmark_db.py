@@ -0,0 +1,153 @@
+"""Бенчмарк слоя базы данных.
+
+Прогоняет типичный "ход" из main.handle_message (проверки игры, участника,
+запись сообщения, чтение истории и статистики) и сравнивает пул соединений
+с открытием нового соединения на каждый вызов.
+
+Запуск: python benchmark_db.py [кол-во ходов]
+Проверка планов запросов: python benchmark_db.py --check-plans
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+import config
+from database import Database
+from storage import MemoryStorage
+
+
+class ConnectPerCallDatabase(Database):
+    """Старое поведение: sqlite3.connect + close на каждый метод"""
+
+    @contextmanager
+    def connection(self):
+        conn = sqlite3.connect(self.db_name)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def play_turn(db: Database, chat_id: int, user_id: int, turn: int):
+    db.is_game_active(chat_id)
+    db.get_game_info(chat_id)
+    db.is_game_active(chat_id)
+    if not db.is_participant(chat_id, user_id):
+        db.get_registered_participants(chat_id)
+        db.add_participant(chat_id, user_id, f"user{user_id}", f"User {user_id}")
+    db.add_participant_message(chat_id, user_id, f"user{user_id}", f"User {user_id}", f"Алиса, сообщение #{turn}")
+    db.get_conversation_history(chat_id)
+    db.get_participant_messages(chat_id, user_id)
+    db.get_participants_stats(chat_id)
+    db.get_game_difficulty(chat_id)
+    db.add_conversation(chat_id, "user", f"User {user_id}: сообщение #{turn}")
+    db.add_conversation(chat_id, "assistant", "Ну и что дальше? 😏")
+
+
+def run(db_class, turns: int, write_behind: bool = False) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DB_NAME = os.path.join(tmp, "bench.db")
+        config.DB_WRITE_BEHIND = write_behind
+        db = db_class()
+        chat_id = -100500
+        db.init_game_session(chat_id, 1, "medium")
+        db.set_game_started(chat_id)
+
+        started = time.perf_counter()
+        for turn in range(turns):
+            play_turn(db, chat_id, 1 + turn % config.MAX_PLAYERS_PER_GAME, turn)
+        db.close()
+        elapsed = time.perf_counter() - started
+        return elapsed
+
+
+def load_conversation_window(db: Database, chat_id: int):
+    # Окно истории обычно отдается из памяти; сбрасываем его, чтобы проверить загрузку из базы
+    db._drop_history(chat_id)
+    db.get_conversation_history(chat_id)
+
+
+# Горячие запросы, которые обязаны идти по индексу
+HOT_QUERIES = {
+    "get_participant_messages(chat_id, user_id)": lambda db, chat_id: db.get_participant_messages(chat_id, 1),
+    "get_participant_messages(chat_id)": lambda db, chat_id: db.get_participant_messages(chat_id),
+    "get_recent_messages_per_participant": lambda db, chat_id: db.get_recent_messages_per_participant(chat_id, 5),
+    "get_participants_stats": lambda db, chat_id: db.get_participants_stats(chat_id),
+    "get_affection_scores": lambda db, chat_id: db.get_affection_scores(chat_id),
+    "get_participant_message_count": lambda db, chat_id: db.get_participant_message_count(chat_id, 1),
+    "get_last_message_time": lambda db, chat_id: db.get_last_message_time(chat_id),
+    "get_conversation_history": load_conversation_window,
+    "prune_archive": lambda db, chat_id: db.prune_archive(config.ARCHIVE_RETENTION_DAYS, config.ARCHIVE_VACUUM_PAGES),
+}
+
+
+def check_query_plans() -> bool:
+    """Через EXPLAIN QUERY PLAN проверяет, что горячие запросы не делают полный скан таблиц"""
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DB_NAME = os.path.join(tmp, "plans.db")
+        db = Database()
+        # Несколько чатов, чтобы у планировщика была реалистичная статистика
+        for chat_id in range(-100520, -100500):
+            db.init_game_session(chat_id, 1, "hard")
+            for turn in range(20):
+                play_turn(db, chat_id, 1 + turn % config.MAX_PLAYERS_PER_GAME, turn)
+
+        with db.connection() as conn:
+            conn.execute('ANALYZE')
+
+        for name, call in HOT_QUERIES.items():
+            statements = []
+            # Однопоточно пул отдает одно и то же соединение, поэтому трассировка видит SQL метода
+            with db.connection() as conn:
+                conn.set_trace_callback(statements.append)
+            call(db, chat_id)
+            with db.connection() as conn:
+                conn.set_trace_callback(None)
+                selects = [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+                if not selects:
+                    print(f"[FAIL] {name}: запрос не перехвачен")
+                    ok = False
+                for sql in selects:
+                    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+                    # SCAN подзапроса/окна - проход по промежуточному результату, а не по таблице
+                    full_scans = [p for p in plan if p.startswith("SCAN") and "USING" not in p and "SUBQUERY" not in p.upper()]
+                    status = "FAIL" if full_scans else "ok"
+                    ok = ok and not full_scans
+                    print(f"[{status}] {name}: {'; '.join(plan)}")
+        db.close()
+    return ok
+
+
+def main():
+    if "--check-plans" in sys.argv:
+        original_db_name = config.DB_NAME
+        try:
+            sys.exit(0 if check_query_plans() else 1)
+        finally:
+            config.DB_NAME = original_db_name
+
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    original_db_name = config.DB_NAME
+    original_write_behind = config.DB_WRITE_BEHIND
+    try:
+        results = {
+            "connect-per-call": run(ConnectPerCallDatabase, turns),
+            "pooled": run(Database, turns),
+            "pooled+write-behind": run(Database, turns, write_behind=True),
+            "memory": run(MemoryStorage, turns),
+        }
+    finally:
+        config.DB_NAME = original_db_name
+        config.DB_WRITE_BEHIND = original_write_behind
+
+    baseline = results["connect-per-call"]
+    for name, elapsed in results.items():
+        print(f"{name:>20}: {elapsed:.3f} s total, {elapsed / turns * 1000:.3f} ms/turn, x{baseline / elapsed:.2f}")
+
+
+if __name__ == '__main__':
+    main()
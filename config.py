@@ -18,8 +18,33 @@ OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 RENDER_APP_URL = os.getenv("RENDER_APP_URL", "")
 BACKUP_CHAT_ID = os.getenv("BACKUP_CHAT_ID", "")
 
+# Бэкапы
+BACKUP_DIR = "backups"                   # Локальная папка для сжатых бэкапов
+BACKUP_KEEP = 7                          # Сколько последних бэкапов хранить локально
+BACKUP_FULL_EVERY_DAYS = 7               # Полный снимок раз в N дней, в остальные дни - инкрементальный
+BACKUP_CHUNK_SIZE = 45 * 1024 * 1024     # Размер части (лимит загрузки документа ботом - 50 МБ)
+
 # База данных
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite, sharded или memory (для тестов и нагрузочных прогонов)
 DB_NAME = "bot_data.db"
+DB_SHARDS = 4             # Количество файлов для STORAGE_BACKEND = "sharded" (bot_data.shard0.db, ...)
+DB_POOL_SIZE = 4          # Сколько соединений SQLite держать открытыми
+DB_BUSY_TIMEOUT = 10      # Ожидание блокировки записи (в секундах)
+DB_CACHE_SIZE_KB = 8192   # Размер page cache на одно соединение
+
+# Отложенная групповая запись сообщений и истории (меньше fsync на ход)
+DB_WRITE_BEHIND = False
+DB_FLUSH_INTERVAL = 0.5   # Как часто коммитить буфер (в секундах)
+DB_FLUSH_MAX_ROWS = 50    # Коммитить раньше, если в буфере столько строк
+
+# Архив завершенных игр
+ARCHIVE_RETENTION_DAYS = 90      # Сколько дней хранить архив (для аналитики и реплея)
+ARCHIVE_PRUNE_INTERVAL = 21600   # Как часто чистить архив (в секундах)
+ARCHIVE_VACUUM_PAGES = 2000      # Сколько страниц освобождать за один incremental_vacuum
+
+# История разговора: в живой таблице и в памяти держится только окно последних реплик,
+# более старые уходят в архив. Столько же реплик получает AI как контекст
+CONVERSATION_WINDOW = 15
 
 # Персонаж бота
 BOT_NAME = "Алиса"
@@ -68,6 +93,56 @@ OPENROUTER_AI_MODEL = "meta-llama/llama-3.3-70b-instruct:free"
 
 AI_MAX_TOKENS = 400
 AI_TEMPERATURE = 0.95  # Чуть повысил для "живости"
+WINNER_MESSAGES_PER_USER = 5  # Сколько последних сообщений каждого участника AI видит при выборе победителя
+AI_WINNER_BUDGET = 1500        # Бюджет токенов на сообщения всех участников при выборе победителя
+
+# Склейка сообщений: пока AI отвечает в чате, новые обращения копятся и получают
+# один общий ответ следующим запросом (вместо отдельного запроса на каждое)
+AI_COALESCE = False            # Обработчики сообщений становятся неблокирующими
+
+# Счет симпатии: в каждом ответе AI оценивает ход автора сообщения, оценки копятся
+# в game_participants. По счету проверки победителя обходятся без отдельного запроса к AI
+AI_AFFECTION_SCORING = True
+AFFECTION_DELTA_LIMIT = 3                                     # Оценка за ход: от -3 до +3
+AFFECTION_WIN_SCORES = {"easy": 8, "medium": 12, "hard": 18}  # Счет, при котором Алиса влюбляется
+
+# Контекст ответа: свежая история упаковывается в бюджет токенов (по сложности),
+# более старые реплики сворачиваются в краткое содержание, которое обновляется в фоне
+AI_CONTEXT_BUDGETS = {"easy": 1200, "medium": 1600, "hard": 2000}
+AI_SUMMARY_BATCH = 6           # Сколько выпавших из контекста реплик копить до фоновой свертки
+AI_SUMMARY_MAX_TOKENS = 200    # Максимальная длина краткого содержания
+
+# HTTP-соединения с провайдерами AI (одна долгоживущая сессия на провайдера)
+AI_HTTP_MAX_CONNECTIONS = 20   # Одновременных соединений на провайдера
+AI_HTTP_KEEPALIVE = 75         # Сколько держать простаивающее соединение открытым (в секундах)
+AI_HTTP_DNS_TTL = 600          # Кэш DNS (в секундах)
+
+# Hedged-запросы: если Groq не ответил за порог, тот же запрос параллельно уходит в OpenRouter,
+# берется первый успешный ответ. Снижает хвостовые задержки ценой части дублированных запросов
+AI_HEDGING = False
+AI_HEDGE_DELAYS = {"easy": 2.5, "medium": 3.0, "hard": 3.5}  # Порог по сложности (в секундах)
+AI_HEDGE_ADAPTIVE = True       # Вместо порога брать p95 задержки Groq, когда накоплено достаточно замеров
+AI_HEDGE_MIN_SAMPLES = 20
+
+# Предохранитель провайдеров: после серии 429/5xx/сетевых ошибок провайдер пропускается
+# на время паузы, затем один пробный запрос (half-open) решает, вернуть ли его
+AI_BREAKER_FAILURES = 3          # Неудач подряд до размыкания
+AI_BREAKER_COOLDOWN = 30         # Пауза, если провайдер не прислал Retry-After (в секундах)
+AI_BREAKER_MAX_COOLDOWN = 3600   # Верхняя граница для Retry-After (в секундах)
+AI_HEALTH_WINDOW = 300           # За какой период доля успехов влияет на выбор провайдера (в секундах)
+
+# Лимиты провайдеров (бесплатные тарифы): запросов и токенов в минуту. Запросы сверх лимита
+# ждут в очереди: ответы в чат раньше фоновой проверки победителя, чаты обслуживаются по кругу
+AI_RATE_LIMITS = {
+    "groq": {"rpm": 30, "tpm": 12000},
+    "openrouter": {"rpm": 20, "tpm": 40000},
+}
+AI_QUEUE_MAX_WAIT = 20           # Сколько запрос может ждать очереди у провайдера (в секундах)
+
+# Потоковые ответы: текст появляется в чате по мере генерации (одно сообщение, которое редактируется)
+AI_STREAMING = False
+STREAM_MIN_CHARS = 20            # Не показывать ответ, пока он короче (заодно не мелькнет "ИГНОР")
+STREAM_EDIT_INTERVAL = 1.0       # Не чаще одной правки сообщения в столько секунд (лимиты Telegram)
 
 # Флаг: может ли Алиса обижаться и игнорировать (True - может, False - нет)
 ENABLE_AI_IGNORE = False
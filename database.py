@@ -1,312 +1,1110 @@
+import os
 import sqlite3
 import json
 import logging
+import queue
+import threading
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Optional, List, Dict
-from datetime import datetime
 import config
+from storage import StorageBackend, now_ms
+from models import GameInfo, Participant, AffectionScore, ParticipantMessage, ConversationTurn, TurnContext, row_factory
 
 logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self):
-        self.db_name = config.DB_NAME
-        self.init_db()
+# ========== МИГРАЦИИ СХЕМЫ ==========
+
+def _column_exists(cursor: sqlite3.Cursor, table: str, column: str) -> bool:
+    cursor.execute(f'PRAGMA table_info({table})')
+    return any(row[1] == column for row in cursor.fetchall())
+
+def _add_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> bool:
+    """Добавить колонку, если ее нет. Возвращает True, если колонка добавлена."""
+    if _column_exists(cursor, table, column):
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def _migration_base_schema(cursor: sqlite3.Cursor):
+    # Таблица для игровых сессий
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_sessions (
+            chat_id INTEGER PRIMARY KEY,
+            is_active INTEGER DEFAULT 1,
+            status TEXT DEFAULT 'waiting', -- waiting, playing, finished
+            difficulty TEXT DEFAULT 'hard',
+            initiator_id INTEGER,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ended_at TIMESTAMP,
+            winner_user_id INTEGER,
+            winner_name TEXT
+        )
+    ''')
     
-    def get_connection(self):
-        return sqlite3.connect(self.db_name)
+    # Таблица для зарегистрированных участников игры
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_participants (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(chat_id, user_id),
+            FOREIGN KEY (chat_id) REFERENCES game_sessions(chat_id)
+        )
+    ''')
+
+    # Таблица для сообщений участников
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS participant_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            message TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES game_sessions(chat_id)
+        )
+    ''')
     
-    def init_db(self):
-        """Инициализация базы данных"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица для игровых сессий
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS game_sessions (
-                chat_id INTEGER PRIMARY KEY,
-                is_active INTEGER DEFAULT 1,
-                status TEXT DEFAULT 'waiting', -- waiting, playing, finished
-                difficulty TEXT DEFAULT 'hard',
-                initiator_id INTEGER,
-                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                ended_at TIMESTAMP,
-                winner_user_id INTEGER,
-                winner_name TEXT
-            )
-        ''')
-        
-        # Таблица для зарегистрированных участников игры
+    # Таблица для истории разговора (для AI контекста)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            role TEXT,
+            content TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES game_sessions(chat_id)
+        )
+    ''')
+    
+    # Колонки, которых нет в базах самых первых версий бота
+    _add_column(cursor, 'game_sessions', 'difficulty', "TEXT DEFAULT 'hard'")
+    _add_column(cursor, 'game_sessions', 'status', "TEXT DEFAULT 'playing'")
+    _add_column(cursor, 'game_sessions', 'initiator_id', 'INTEGER')
+
+def _migration_hot_indexes(cursor: sqlite3.Cursor):
+    # Сообщения участника
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_participant_messages_chat_user_ts
+        ON participant_messages (chat_id, user_id, timestamp)
+    ''')
+    # Все сообщения чата по времени и последнее сообщение (покрывающий)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_participant_messages_chat_ts
+        ON participant_messages (chat_id, timestamp)
+    ''')
+    # Последние N записей истории разговора
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversation_history_chat_ts
+        ON conversation_history (chat_id, timestamp)
+    ''')
+
+def _migration_participant_aggregates(cursor: sqlite3.Cursor):
+    # Агрегаты обновляются при каждом сообщении участника
+    _add_column(cursor, 'game_participants', 'message_count', 'INTEGER DEFAULT 0')
+    _add_column(cursor, 'game_participants', 'last_message_at', 'TIMESTAMP')
+    if _add_column(cursor, 'game_participants', 'total_chars', 'INTEGER DEFAULT 0'):
+        # Один раз пересчитываем агрегаты по уже накопленным сообщениям
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS game_participants (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                user_id INTEGER,
-                username TEXT,
-                first_name TEXT,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(chat_id, user_id),
-                FOREIGN KEY (chat_id) REFERENCES game_sessions(chat_id)
-            )
+            UPDATE game_participants SET
+                message_count = (SELECT COUNT(*) FROM participant_messages m
+                                 WHERE m.chat_id = game_participants.chat_id AND m.user_id = game_participants.user_id),
+                last_message_at = (SELECT MAX(timestamp) FROM participant_messages m
+                                   WHERE m.chat_id = game_participants.chat_id AND m.user_id = game_participants.user_id),
+                total_chars = (SELECT COALESCE(SUM(LENGTH(message)), 0) FROM participant_messages m
+                               WHERE m.chat_id = game_participants.chat_id AND m.user_id = game_participants.user_id)
         ''')
 
-        # Таблица для сообщений участников
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS participant_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                user_id INTEGER,
-                username TEXT,
-                first_name TEXT,
-                message TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES game_sessions(chat_id)
-            )
+def _migration_backup_state(cursor: sqlite3.Cursor):
+    # Последний id, попавший в бэкап, для инкрементальных бэкапов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_state (
+            table_name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def _migration_archive_tables(cursor: sqlite3.Cursor):
+    # Завершенные игры: компактная копия без дублирования имен в каждом сообщении
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_games (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            difficulty TEXT,
+            initiator_id INTEGER,
+            started_at TIMESTAMP,
+            ended_at TIMESTAMP,
+            winner_user_id INTEGER,
+            winner_name TEXT,
+            participants TEXT -- JSON: [{user_id, username, first_name, message_count, total_chars}]
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id INTEGER,
+            chat_id INTEGER,
+            user_id INTEGER,
+            message TEXT,
+            timestamp TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_conversation (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id INTEGER,
+            chat_id INTEGER,
+            role TEXT,
+            content TEXT,
+            timestamp TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_games_ended_at ON archived_games (ended_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_games_chat ON archived_games (chat_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_messages_game ON archived_messages (game_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_conversation_game ON archived_conversation (game_id)')
+
+# Все временные колонки: (таблица, колонка)
+TIMESTAMP_COLUMNS = [
+    ('game_sessions', 'started_at'), ('game_sessions', 'ended_at'),
+    ('game_participants', 'joined_at'), ('game_participants', 'last_message_at'),
+    ('participant_messages', 'timestamp'), ('conversation_history', 'timestamp'),
+    ('archived_games', 'started_at'), ('archived_games', 'ended_at'),
+    ('archived_messages', 'timestamp'), ('archived_conversation', 'timestamp'),
+]
+
+def _migration_epoch_ms_timestamps(cursor: sqlite3.Cursor):
+    # Время хранится как INTEGER миллисекунды Unix epoch (UTC): сравнения и сортировка
+    # идут по числам, без парсинга строк. Код всегда передает время явно,
+    # DEFAULT CURRENT_TIMESTAMP в старых CREATE TABLE больше не используется.
+    for table, column in TIMESTAMP_COLUMNS:
+        cursor.execute(f'''
+            UPDATE {table}
+            SET {column} = CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)
+            WHERE typeof({column}) = 'text'
         ''')
+
+# id реплик, входящих в окно истории чата (параметры: chat_id, размер окна)
+_HISTORY_WINDOW_IDS = '''
+    SELECT id FROM conversation_history WHERE chat_id = ?
+    ORDER BY timestamp DESC, id DESC LIMIT ?
+'''
+
+def _migration_conversation_window(cursor: sqlite3.Cursor):
+    # Реплики, вытесненные из окна, лежат в архиве с game_id = NULL до конца игры
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_archived_conversation_unassigned
+        ON archived_conversation (chat_id) WHERE game_id IS NULL
+    ''')
+    # Старая история длиннее окна переезжает в архив один раз
+    cursor.execute('''
+        CREATE TEMP TABLE conversation_overflow AS
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY timestamp DESC, id DESC) AS position
+            FROM conversation_history
+        ) WHERE position > ?
+    ''', (config.CONVERSATION_WINDOW,))
+    cursor.execute('''
+        INSERT INTO archived_conversation (game_id, chat_id, role, content, timestamp)
+        SELECT NULL, chat_id, role, content, timestamp FROM conversation_history
+        WHERE id IN (SELECT id FROM conversation_overflow) ORDER BY id
+    ''')
+    cursor.execute('DELETE FROM conversation_history WHERE id IN (SELECT id FROM conversation_overflow)')
+    cursor.execute('DROP TABLE conversation_overflow')
+
+def _migration_participant_affection(cursor: sqlite3.Cursor):
+    # Накопленная оценка симпатии к участнику (сумма оценок AI за ходы)
+    _add_column(cursor, 'game_participants', 'affection', 'INTEGER DEFAULT 0')
+
+# (версия, описание, функция). Новые шаги (таблицы, индексы, колонки) добавляются только в конец.
+MIGRATIONS = [
+    (1, "base schema", _migration_base_schema),
+    (2, "hot query indexes", _migration_hot_indexes),
+    (3, "participant message aggregates", _migration_participant_aggregates),
+    (4, "backup state", _migration_backup_state),
+    (5, "archive tables", _migration_archive_tables),
+    (6, "epoch millisecond timestamps", _migration_epoch_ms_timestamps),
+    (7, "conversation window", _migration_conversation_window),
+    (8, "participant affection", _migration_participant_affection),
+]
+
+# Append-only таблицы: в инкрементальный бэкап попадают строки с id больше последнего забэкапленного
+INCREMENTAL_BACKUP_TABLES = (
+    'participant_messages', 'conversation_history',
+    'archived_games', 'archived_messages', 'archived_conversation'
+)
+# Небольшие изменяемые таблицы: в инкрементальный бэкап попадают целиком
+SNAPSHOT_BACKUP_TABLES = ('game_sessions', 'game_participants')
+# Строка backup_state со временем (мс) последнего отправленного полного бэкапа
+FULL_BACKUP_MARK = 'full_backup'
+
+
+def _select_records(cursor: sqlite3.Cursor, record_type, sql: str, params: tuple) -> list:
+    """SELECT, строки которого курсор сразу создает как record_type.
+
+    Отдельный курсор той же транзакции, чтобы row_factory не влиял на другие запросы.
+    """
+    records = cursor.connection.cursor()
+    records.row_factory = row_factory(record_type)
+    return records.execute(sql, params).fetchall()
+
+
+class Database(StorageBackend):
+    """Хранилище на SQLite (движок по умолчанию)"""
+    
+    supports_backup = True
+    
+    def __init__(self, db_name: Optional[str] = None):
+        self.db_name = db_name or config.DB_NAME
+        # Пул долгоживущих соединений (вместо connect/close на каждый вызов)
+        self._pool = queue.Queue(maxsize=config.DB_POOL_SIZE)
         
-        # Таблица для истории разговора (для AI контекста)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversation_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                role TEXT,
-                content TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES game_sessions(chat_id)
-            )
-        ''')
+        # Отложенная запись (write-behind): вставки сообщений и истории копятся
+        # в буфере и коммитятся группой по таймеру или по размеру буфера
+        self._pending_writes = []
+        self._pending_chats = set()
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_stop = threading.Event()
+        self._flusher = None
         
-        # Миграции для старых баз данных
-        try:
-            cursor.execute('ALTER TABLE game_sessions ADD COLUMN difficulty TEXT DEFAULT "hard"')
-        except sqlite3.OperationalError:
-            pass
-            
+        # Write-through кэш сессий: {chat_id: game_info или None, если игры нет}.
+        # Строка game_sessions меняется только в init_game_session, set_game_started и end_game
+        self._sessions: Dict[int, Optional[GameInfo]] = {}
+        self._sessions_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        
+        # Окно истории разговора в памяти: {chat_id: deque последних CONVERSATION_WINDOW реплик}.
+        # Загружается из базы при первом обращении и дальше обновляется вместе с записью
+        self._history: Dict[int, deque] = {}
+        # Блокировки по чатам: запись и загрузка окна одного чата не задерживают другие чаты
+        self._history_locks: Dict[int, threading.Lock] = {}
+        self._history_lock = threading.Lock()
+        
+        # Отметки последнего снятого бэкапа, сохраняются после успешной отправки
+        self._pending_backup_marks: Optional[Dict[str, int]] = None
+        
+        self.init_db()
+        
+        if config.DB_WRITE_BEHIND:
+            self._flusher = threading.Thread(target=self._flush_loop, name="sqlite-flusher", daemon=True)
+            self._flusher.start()
+    
+    def _create_connection(self) -> sqlite3.Connection:
+        """Открывает новое соединение и один раз настраивает PRAGMA"""
+        conn = sqlite3.connect(self.db_name, timeout=config.DB_BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute(f'PRAGMA cache_size = -{config.DB_CACHE_SIZE_KB}')
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Берет соединение из пула и возвращает его обратно после использования"""
         try:
-            cursor.execute('ALTER TABLE game_sessions ADD COLUMN status TEXT DEFAULT "playing"')
-        except sqlite3.OperationalError:
-            pass
-            
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._create_connection()
         try:
-            cursor.execute('ALTER TABLE game_sessions ADD COLUMN initiator_id INTEGER')
-        except sqlite3.OperationalError:
-            pass
+            yield conn
+        finally:
+            # Незакрытая транзакция (например, после IntegrityError) не должна держать блокировку
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    def close(self):
+        """Сбросить буфер записи и закрыть все соединения пула"""
+        if self._flusher:
+            self._flush_stop.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+    
+    def _enqueue_write(self, chat_id: int, statements: List[tuple]):
+        """Записать сразу или положить в буфер write-behind (statements: [(sql, params), ...])"""
+        if not config.DB_WRITE_BEHIND:
+            with self.connection() as conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+                conn.commit()
+            return
         
+        with self._pending_lock:
+            self._pending_writes.extend(statements)
+            self._pending_chats.add(chat_id)
+            buffer_full = len(self._pending_writes) >= config.DB_FLUSH_MAX_ROWS
+        if buffer_full:
+            self.flush()
+    
+    def flush(self):
+        """Закоммитить все отложенные вставки одной транзакцией"""
+        # Флаш сериализован, чтобы строки попадали в базу в порядке поступления
+        with self._flush_lock:
+            with self._pending_lock:
+                writes, chats = self._pending_writes, self._pending_chats
+                self._pending_writes = []
+                self._pending_chats = set()
+            if not writes:
+                return
+            
+            try:
+                with self.connection() as conn:
+                    for sql, params in writes:
+                        conn.execute(sql, params)
+                    conn.commit()
+            except Exception:
+                # Транзакция откатилась: возвращаем строки в начало буфера, следующий флаш повторит их
+                with self._pending_lock:
+                    self._pending_writes = writes + self._pending_writes
+                    self._pending_chats |= chats
+                raise
+    
+    def _flush_chat(self, chat_id: int):
+        """Чтения по чату должны видеть его отложенные строки"""
+        if chat_id in self._pending_chats:
+            self.flush()
+    
+    def _flush_loop(self):
+        while not self._flush_stop.wait(config.DB_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing write-behind buffer: {e}")
+    
+    def init_db(self):
+        """Применить недостающие миграции схемы (версия хранится в PRAGMA user_version)"""
+        with self.connection() as conn:
+            # Быстрый путь при обычном старте: схема уже актуальна
+            if conn.execute('PRAGMA user_version').fetchone()[0] < MIGRATIONS[-1][0]:
+                self._apply_migrations(conn)
+            
+            # Архив чистится через incremental_vacuum; старый файл переводим в этот режим один раз
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+    
+    def _apply_migrations(self, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        # Перечитываем версию под блокировкой записи
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        pending = [m for m in MIGRATIONS if m[0] > version]
+        for number, description, migrate in pending:
+            logger.info(f"Applying DB migration {number}: {description}")
+            migrate(cursor)
+        if pending:
+            cursor.execute(f'PRAGMA user_version = {pending[-1][0]}')
+        # Все недостающие шаги применяются одной транзакцией
         conn.commit()
-        conn.close()
     
     def init_game_session(self, chat_id: int, initiator_id: int, difficulty: str = "hard"):
         """Создать сессию игры в режиме ожидания (Лобби)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        self._flush_chat(chat_id)
+        now = now_ms()
+        with self.connection() as conn:
+            cursor = conn.cursor()
         
-        # Завершить предыдущую
-        cursor.execute('UPDATE game_sessions SET is_active = 0, ended_at = CURRENT_TIMESTAMP WHERE chat_id = ? AND is_active = 1', (chat_id,))
+            # Завершить предыдущую
+            cursor.execute('UPDATE game_sessions SET is_active = 0, ended_at = ? WHERE chat_id = ? AND is_active = 1', (now, chat_id))
         
-        # Очистить старые данные
-        cursor.execute('DELETE FROM participant_messages WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM conversation_history WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM game_participants WHERE chat_id = ?', (chat_id,))
+            # Перенести в архив все, что осталось в живых таблицах от прошлых игр
+            self._archive_game(cursor, chat_id)
         
-        # Создаем или обновляем сессию
-        cursor.execute('SELECT chat_id FROM game_sessions WHERE chat_id = ?', (chat_id,))
-        exists = cursor.fetchone()
+            # Создаем или обновляем сессию
+            cursor.execute('SELECT chat_id FROM game_sessions WHERE chat_id = ?', (chat_id,))
+            exists = cursor.fetchone()
         
-        if exists:
-            cursor.execute('''
-                UPDATE game_sessions 
-                SET is_active = 1, status = 'waiting', difficulty = ?, initiator_id = ?, 
-                    started_at = CURRENT_TIMESTAMP, ended_at = NULL, winner_user_id = NULL, winner_name = NULL
-                WHERE chat_id = ?
-            ''', (difficulty, initiator_id, chat_id,))
-        else:
-            cursor.execute('''
-                INSERT INTO game_sessions (chat_id, is_active, status, difficulty, initiator_id) 
-                VALUES (?, 1, 'waiting', ?, ?)
-            ''', (chat_id, difficulty, initiator_id))
+            if exists:
+                cursor.execute('''
+                    UPDATE game_sessions 
+                    SET is_active = 1, status = 'waiting', difficulty = ?, initiator_id = ?, 
+                        started_at = ?, ended_at = NULL, winner_user_id = NULL, winner_name = NULL
+                    WHERE chat_id = ?
+                ''', (difficulty, initiator_id, now, chat_id,))
+            else:
+                cursor.execute('''
+                    INSERT INTO game_sessions (chat_id, is_active, status, difficulty, initiator_id, started_at) 
+                    VALUES (?, 1, 'waiting', ?, ?, ?)
+                ''', (chat_id, difficulty, initiator_id, now))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+            self._cache_session(chat_id, self._fetch_game_info(cursor, chat_id))
+        self._drop_history(chat_id)
         logger.info(f"Initialized lobby for chat {chat_id}, difficulty {difficulty}")
 
     def add_participant(self, chat_id: int, user_id: int, username: str, first_name: str) -> bool:
         """Добавить участника в игру. Возвращает True если добавлен, False если уже был."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            added = self._insert_participant(conn.cursor(), chat_id, user_id, username, first_name)
+            conn.commit()
+            return added
+
+    def _insert_participant(self, cursor: sqlite3.Cursor, chat_id: int, user_id: int, username: str, first_name: str) -> bool:
         try:
             cursor.execute('''
-                INSERT INTO game_participants (chat_id, user_id, username, first_name)
-                VALUES (?, ?, ?, ?)
-            ''', (chat_id, user_id, username or "", first_name or "Аноним"))
-            conn.commit()
+                INSERT INTO game_participants (chat_id, user_id, username, first_name, joined_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, user_id, username or "", first_name or "Аноним", now_ms()))
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
 
-    def get_registered_participants(self, chat_id: int) -> List[Dict]:
+    def get_registered_participants(self, chat_id: int) -> List[Participant]:
         """Получить список зарегистрированных участников"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, first_name FROM game_participants WHERE chat_id = ?', (chat_id,))
-        results = cursor.fetchall()
-        conn.close()
-        return [{'user_id': r[0], 'username': r[1], 'first_name': r[2]} for r in results]
+        with self.connection() as conn:
+            return self._fetch_registered_participants(conn.cursor(), chat_id)
+
+    def _fetch_registered_participants(self, cursor: sqlite3.Cursor, chat_id: int) -> List[Participant]:
+        return _select_records(cursor, Participant, '''
+            SELECT user_id, username, first_name, message_count FROM game_participants WHERE chat_id = ?
+        ''', (chat_id,))
 
     def is_participant(self, chat_id: int, user_id: int) -> bool:
         """Проверить, является ли пользователь участником"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM game_participants WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
-        result = cursor.fetchone()
-        conn.close()
-        return bool(result)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM game_participants WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+            result = cursor.fetchone()
+            return bool(result)
 
     def set_game_started(self, chat_id: int):
         """Перевести игру в статус 'playing'"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE game_sessions SET status = 'playing', started_at = CURRENT_TIMESTAMP WHERE chat_id = ? AND is_active = 1", (chat_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE game_sessions SET status = 'playing', started_at = ? WHERE chat_id = ? AND is_active = 1", (now_ms(), chat_id))
+            conn.commit()
+            self._cache_session(chat_id, self._fetch_game_info(cursor, chat_id))
 
-    def get_game_info(self, chat_id: int) -> Optional[Dict]:
-        """Получить информацию о текущей игре"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+    def get_game_info(self, chat_id: int) -> Optional[GameInfo]:
+        """Получить информацию о текущей игре (из кэша сессий, если есть)"""
+        # GameInfo неизменяемый, поэтому из кэша отдается без копирования
+        with self._sessions_lock:
+            if chat_id in self._sessions:
+                self.cache_hits += 1
+                return self._sessions[chat_id]
+            self.cache_misses += 1
+        
+        with self.connection() as conn:
+            info = self._fetch_game_info(conn.cursor(), chat_id)
+        with self._sessions_lock:
+            # Мутатор мог успеть записать более свежее состояние
+            self._sessions.setdefault(chat_id, info)
+        return info
+
+    def _cache_session(self, chat_id: int, info: Optional[GameInfo]):
+        with self._sessions_lock:
+            self._sessions[chat_id] = info
+
+    def cache_stats(self) -> Dict:
+        """Счетчики кэша сессий"""
+        with self._sessions_lock:
+            return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self._sessions)}
+
+    def _fetch_game_info(self, cursor: sqlite3.Cursor, chat_id: int) -> Optional[GameInfo]:
+        results = _select_records(cursor, GameInfo, '''
             SELECT status, difficulty, initiator_id, is_active 
             FROM game_sessions 
             WHERE chat_id = ? AND is_active = 1
         ''', (chat_id,))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            return {
-                'status': result[0],
-                'difficulty': result[1],
-                'initiator_id': result[2],
-                'is_active': result[3]
-            }
-        return None
+        return results[0] if results else None
 
-    def is_game_active(self, chat_id: int) -> bool:
-        """Проверить активна ли игра (в любом статусе)"""
-        info = self.get_game_info(chat_id)
-        return info is not None and info['is_active'] == 1
-
-    def is_game_playing(self, chat_id: int) -> bool:
-        """Проверить, идет ли сам процесс игры (статус playing)"""
-        info = self.get_game_info(chat_id)
-        return info is not None and info['is_active'] == 1 and info['status'] == 'playing'
-
-    def get_game_difficulty(self, chat_id: int) -> str:
-        info = self.get_game_info(chat_id)
-        return info['difficulty'] if info else "hard"
-    
     def end_game(self, chat_id: int, winner_user_id: Optional[int] = None, winner_name: Optional[str] = None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE game_sessions 
-            SET is_active = 0, ended_at = CURRENT_TIMESTAMP, winner_user_id = ?, winner_name = ?
-            WHERE chat_id = ? AND is_active = 1
-        ''', (winner_user_id, winner_name, chat_id))
-        conn.commit()
-        conn.close()
+        # Конец игры - точка durability: все сообщения игры должны быть на диске
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE game_sessions 
+                SET is_active = 0, ended_at = ?, winner_user_id = ?, winner_name = ?
+                WHERE chat_id = ? AND is_active = 1
+            ''', (now_ms(), winner_user_id, winner_name, chat_id))
+            if cursor.rowcount:
+                # Живые таблицы держат только активные игры
+                self._archive_game(cursor, chat_id)
+            conn.commit()
+            self._cache_session(chat_id, None)
+        self._drop_history(chat_id)
         logger.info(f"Ended game for chat {chat_id}, winner: {winner_name}")
     
-    def add_participant_message(self, chat_id: int, user_id: int, username: str, first_name: str, message: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _archive_game(self, cursor: sqlite3.Cursor, chat_id: int) -> Optional[int]:
+        """Перенести данные завершенной игры в архивные таблицы и очистить живые.
+
+        Возвращает id архивной игры или None, если переносить нечего.
+        """
         cursor.execute('''
-            INSERT INTO participant_messages (chat_id, user_id, username, first_name, message)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (chat_id, user_id, username or "", first_name or "Аноним", message))
-        conn.commit()
-        conn.close()
-    
-    def get_participant_messages(self, chat_id: int, user_id: Optional[int] = None) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        if user_id:
-            cursor.execute('''
-                SELECT user_id, username, first_name, message, timestamp 
-                FROM participant_messages 
-                WHERE chat_id = ? AND user_id = ?
-                ORDER BY timestamp
-            ''', (chat_id, user_id))
-        else:
+            SELECT user_id, username, first_name, message_count, total_chars, affection
+            FROM game_participants WHERE chat_id = ?
+        ''', (chat_id,))
+        participants = [
+            {'user_id': r[0], 'username': r[1], 'first_name': r[2], 'message_count': r[3], 'total_chars': r[4],
+             'affection': r[5]}
+            for r in cursor.fetchall()
+        ]
+        cursor.execute('''
+            SELECT EXISTS(SELECT 1 FROM participant_messages WHERE chat_id = ?)
+                OR EXISTS(SELECT 1 FROM conversation_history WHERE chat_id = ?)
+        ''', (chat_id, chat_id))
+        if not participants and not cursor.fetchone()[0]:
+            return None
+        
+        cursor.execute('''
+            INSERT INTO archived_games (chat_id, difficulty, initiator_id, started_at, ended_at, winner_user_id, winner_name, participants)
+            SELECT chat_id, difficulty, initiator_id, started_at, COALESCE(ended_at, ?), winner_user_id, winner_name, ?
+            FROM game_sessions WHERE chat_id = ?
+        ''', (now_ms(), json.dumps(participants, ensure_ascii=False), chat_id))
+        game_id = cursor.lastrowid
+        
+        # Реплики, вытесненные из окна истории во время игры, уже в архиве
+        cursor.execute('''
+            UPDATE archived_conversation SET game_id = ? WHERE chat_id = ? AND game_id IS NULL
+        ''', (game_id, chat_id))
+        
+        # Имена участников хранятся один раз в archived_games.participants
+        cursor.execute('''
+            INSERT INTO archived_messages (game_id, chat_id, user_id, message, timestamp)
+            SELECT ?, chat_id, user_id, message, timestamp FROM participant_messages WHERE chat_id = ? ORDER BY id
+        ''', (game_id, chat_id))
+        cursor.execute('''
+            INSERT INTO archived_conversation (game_id, chat_id, role, content, timestamp)
+            SELECT ?, chat_id, role, content, timestamp FROM conversation_history WHERE chat_id = ? ORDER BY id
+        ''', (game_id, chat_id))
+        
+        cursor.execute('DELETE FROM participant_messages WHERE chat_id = ?', (chat_id,))
+        cursor.execute('DELETE FROM conversation_history WHERE chat_id = ?', (chat_id,))
+        cursor.execute('DELETE FROM game_participants WHERE chat_id = ?', (chat_id,))
+        return game_id
+
+    def prune_archive(self, retention_days: int, vacuum_pages: int) -> int:
+        """Удалить архивные игры старше retention_days и вернуть место через incremental_vacuum"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # Диапазонный скан по индексу idx_archived_games_ended_at
+            cutoff = now_ms() - retention_days * 86400 * 1000
+            cursor.execute('SELECT id FROM archived_games WHERE ended_at < ?', (cutoff,))
+            game_ids = [(r[0],) for r in cursor.fetchall()]
+            if game_ids:
+                cursor.executemany('DELETE FROM archived_messages WHERE game_id = ?', game_ids)
+                cursor.executemany('DELETE FROM archived_conversation WHERE game_id = ?', game_ids)
+                cursor.executemany('DELETE FROM archived_games WHERE id = ?', game_ids)
+            # Реплики, вытесненные из окна в игре, которая так и не была заархивирована
+            # (например, процесс упал до end_game): по индексу idx_archived_conversation_unassigned
             cursor.execute('''
-                SELECT user_id, username, first_name, message, timestamp 
-                FROM participant_messages 
-                WHERE chat_id = ?
-                ORDER BY timestamp
-            ''', (chat_id,))
-        results = cursor.fetchall()
-        conn.close()
+                DELETE FROM archived_conversation WHERE game_id IS NULL AND timestamp < ?
+            ''', (cutoff,))
+            orphaned = cursor.rowcount
+            if game_ids or orphaned:
+                conn.commit()
+            # Небольшими порциями, чтобы не держать блокировку записи надолго
+            conn.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})').fetchall()
+        if game_ids or orphaned:
+            logger.info(f"Pruned {len(game_ids)} archived games and {orphaned} unassigned turns older than {retention_days} days")
+        return len(game_ids)
+
+    def record_turn(self, chat_id: int, user_id: int, username: str, first_name: str,
+                    message: str, history_limit: Optional[int] = None) -> Optional[TurnContext]:
+        """Записать сообщение участника и собрать контекст хода AI одной транзакцией.
+
+        Если пользователь еще не участник и есть свободное место — добавляет его.
+        Возвращает None, если активной игры нет. Если мест нет, сообщение не
+        записывается и возвращается контекст с is_participant = False.
+        """
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # Сразу берем блокировку записи, чтобы между чтениями ничего не поменялось
+            cursor.execute('BEGIN IMMEDIATE')
+
+            game_info = self._fetch_game_info(cursor, chat_id)
+            if not game_info:
+                return None
+
+            participants = self._fetch_registered_participants(cursor, chat_id)
+            is_participant = any(p.user_id == user_id for p in participants)
+            if not is_participant and len(participants) < config.MAX_PLAYERS_PER_GAME:
+                is_participant = self._insert_participant(cursor, chat_id, user_id, username, first_name)
+                participants = self._fetch_registered_participants(cursor, chat_id)
+
+            if not is_participant:
+                return TurnContext(game_info.status, game_info.difficulty, False, participants)
+
+            for sql, params in self._participant_message_writes(chat_id, user_id, username, first_name, message):
+                cursor.execute(sql, params)
+
+            user_messages_count = self._fetch_participant_message_count(cursor, chat_id, user_id)
+            participants_stats = self._fetch_participants_stats(cursor, chat_id)
+
+            conn.commit()
+        # Ход не пишет в историю разговора, окно берется из памяти
+        return TurnContext(
+            game_info.status, game_info.difficulty, True, participants,
+            user_messages_count, participants_stats,
+            self.get_conversation_history(chat_id, history_limit)
+        )
+
+    def add_participant_message(self, chat_id: int, user_id: int, username: str, first_name: str, message: str):
+        self._enqueue_write(chat_id, self._participant_message_writes(chat_id, user_id, username, first_name, message))
+    
+    def _participant_message_writes(self, chat_id: int, user_id: int, username: str, first_name: str, message: str) -> List[tuple]:
+        """Вставка сообщения и обновление агрегатов участника"""
+        # Время фиксируем при поступлении, а не при флаше буфера
+        timestamp = now_ms()
         return [
-            {'user_id': r[0], 'username': r[1], 'first_name': r[2], 'message': r[3], 'timestamp': r[4]}
-            for r in results
+            ('''
+                INSERT INTO participant_messages (chat_id, user_id, username, first_name, message, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (chat_id, user_id, username or "", first_name or "Аноним", message, timestamp)),
+            ('''
+                UPDATE game_participants
+                SET message_count = message_count + 1, last_message_at = ?, total_chars = total_chars + ?
+                WHERE chat_id = ? AND user_id = ?
+            ''', (timestamp, len(message), chat_id, user_id)),
         ]
     
-    def get_participants_stats(self, chat_id: int) -> List[Dict]:
+    def get_participant_message_count(self, chat_id: int, user_id: int) -> int:
+        """Количество сообщений участника (из агрегата, без скана сообщений)"""
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            return self._fetch_participant_message_count(conn.cursor(), chat_id, user_id)
+
+    def _fetch_participant_message_count(self, cursor: sqlite3.Cursor, chat_id: int, user_id: int) -> int:
+        cursor.execute('SELECT message_count FROM game_participants WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+    
+    def get_participant_messages(self, chat_id: int, user_id: Optional[int] = None) -> List[ParticipantMessage]:
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = row_factory(ParticipantMessage)
+            if user_id:
+                cursor.execute('''
+                    SELECT user_id, username, first_name, message, timestamp 
+                    FROM participant_messages 
+                    WHERE chat_id = ? AND user_id = ?
+                    ORDER BY timestamp
+                ''', (chat_id, user_id))
+            else:
+                cursor.execute('''
+                    SELECT user_id, username, first_name, message, timestamp 
+                    FROM participant_messages 
+                    WHERE chat_id = ?
+                    ORDER BY timestamp
+                ''', (chat_id,))
+            return cursor.fetchall()
+    
+    def get_recent_messages_per_participant(self, chat_id: int, per_user: int) -> List[ParticipantMessage]:
+        """Последние per_user сообщений каждого участника (для выбора победителя)"""
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = row_factory(ParticipantMessage)
+            # Окно идет по индексу (chat_id, user_id, timestamp) в прямом порядке, без сортировки:
+            # позиция с конца = COUNT - ROW_NUMBER. В Python попадают только N строк на участника
+            cursor.execute('''
+                SELECT user_id, username, first_name, message, timestamp
+                FROM (
+                    SELECT user_id, username, first_name, message, timestamp,
+                           COUNT(*) OVER (PARTITION BY user_id)
+                               - ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp, id) AS position
+                    FROM participant_messages
+                    WHERE chat_id = ?
+                )
+                WHERE position < ?
+                ORDER BY user_id, timestamp
+            ''', (chat_id, per_user))
+            return cursor.fetchall()
+    
+    def get_participants_stats(self, chat_id: int) -> List[Participant]:
         """Статистика сообщений для промпта (только активные сообщения)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT DISTINCT user_id, username, first_name, COUNT(*) as message_count
-            FROM participant_messages 
-            WHERE chat_id = ?
-            GROUP BY user_id
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            return self._fetch_participants_stats(conn.cursor(), chat_id)
+
+    def _fetch_participants_stats(self, cursor: sqlite3.Cursor, chat_id: int) -> List[Participant]:
+        # O(участников): агрегаты поддерживаются при вставке сообщений
+        return _select_records(cursor, Participant, '''
+            SELECT user_id, username, first_name, message_count
+            FROM game_participants 
+            WHERE chat_id = ? AND message_count > 0
             ORDER BY message_count DESC
         ''', (chat_id,))
-        results = cursor.fetchall()
-        conn.close()
-        return [
-            {'user_id': r[0], 'username': r[1], 'first_name': r[2], 'message_count': r[3]}
-            for r in results
-        ]
+    
+    def add_affection(self, chat_id: int, user_id: int, delta: int):
+        self._enqueue_write(chat_id, [('''
+            UPDATE game_participants SET affection = affection + ? WHERE chat_id = ? AND user_id = ?
+        ''', (delta, chat_id, user_id))])
+
+    def get_affection_scores(self, chat_id: int) -> List[AffectionScore]:
+        """Счет симпатии участников, по убыванию"""
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            return _select_records(conn.cursor(), AffectionScore, '''
+                SELECT user_id, username, first_name, affection
+                FROM game_participants
+                WHERE chat_id = ?
+                ORDER BY affection DESC
+            ''', (chat_id,))
     
     def add_conversation(self, chat_id: int, role: str, content: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO conversation_history (chat_id, role, content)
-            VALUES (?, ?, ?)
-        ''', (chat_id, role, content))
-        conn.commit()
-        conn.close()
+        turn = ConversationTurn(role, content, now_ms())
+        window = config.CONVERSATION_WINDOW
+        statements = [
+            ('''
+                INSERT INTO conversation_history (chat_id, role, content, timestamp)
+                VALUES (?, ?, ?, ?)
+            ''', (chat_id, role, content, turn.timestamp)),
+            # Реплики за пределами окна переезжают в архив (game_id проставит _archive_game)
+            (f'''
+                INSERT INTO archived_conversation (game_id, chat_id, role, content, timestamp)
+                SELECT NULL, chat_id, role, content, timestamp FROM conversation_history
+                WHERE chat_id = ? AND id NOT IN ({_HISTORY_WINDOW_IDS})
+                ORDER BY id
+            ''', (chat_id, chat_id, window)),
+            (f'''
+                DELETE FROM conversation_history
+                WHERE chat_id = ? AND id NOT IN ({_HISTORY_WINDOW_IDS})
+            ''', (chat_id, chat_id, window)),
+        ]
+        # Под блокировкой окна чата, чтобы загрузка окна из базы не задвоила реплику
+        with self._chat_history_lock(chat_id):
+            self._enqueue_write(chat_id, statements)
+            history = self._history.get(chat_id)
+            if history is not None:
+                history.append(turn)
     
-    def get_conversation_history(self, chat_id: int, limit: int = 50) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+    def get_conversation_history(self, chat_id: int, limit: Optional[int] = None) -> List[ConversationTurn]:
+        """Последние реплики разговора: O(окна), из памяти без запроса к базе"""
+        with self._chat_history_lock(chat_id):
+            history = self._history.get(chat_id)
+            if history is None:
+                self._flush_chat(chat_id)
+                with self.connection() as conn:
+                    turns = self._fetch_conversation_history(conn.cursor(), chat_id, config.CONVERSATION_WINDOW)
+                history = self._history[chat_id] = deque(turns, maxlen=config.CONVERSATION_WINDOW)
+            turns = list(history)
+        if limit is not None:
+            turns = turns[max(len(turns) - limit, 0):]
+        return turns
+    
+    def _drop_history(self, chat_id: int):
+        """Сбросить окно чата (после архивации игры)"""
+        with self._chat_history_lock(chat_id):
+            self._history.pop(chat_id, None)
+            # Блокировки завершенных игр не копятся; ждущие ее потоки возьмут новую
+            with self._history_lock:
+                self._history_locks.pop(chat_id, None)
+
+    @contextmanager
+    def _chat_history_lock(self, chat_id: int):
+        while True:
+            with self._history_lock:
+                lock = self._history_locks.setdefault(chat_id, threading.Lock())
+            lock.acquire()
+            # Пока ждали, _drop_history мог убрать эту блокировку из реестра
+            with self._history_lock:
+                if self._history_locks.get(chat_id) is lock:
+                    break
+            lock.release()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _fetch_conversation_history(self, cursor: sqlite3.Cursor, chat_id: int, limit: int) -> List[ConversationTurn]:
+        results = _select_records(cursor, ConversationTurn, '''
             SELECT role, content, timestamp 
             FROM conversation_history 
             WHERE chat_id = ?
-            ORDER BY timestamp DESC
+            ORDER BY timestamp DESC, id DESC
             LIMIT ?
         ''', (chat_id, limit))
-        results = cursor.fetchall()
-        conn.close()
-        return [{'role': r[0], 'content': r[1], 'timestamp': r[2]} for r in reversed(results)]
+        results.reverse()
+        return results
     
-    def get_game_start_time(self, chat_id: int) -> Optional[str]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT started_at FROM game_sessions WHERE chat_id = ? AND is_active = 1', (chat_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
-
-    def get_last_message_time(self, chat_id: int) -> Optional[str]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT timestamp FROM participant_messages WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 1', (chat_id,))
-        result = cursor.fetchone()
-        if not result:
+    def get_game_start_time(self, chat_id: int) -> Optional[int]:
+        with self.connection() as conn:
+            cursor = conn.cursor()
             cursor.execute('SELECT started_at FROM game_sessions WHERE chat_id = ? AND is_active = 1', (chat_id,))
             result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
+            return result[0] if result else None
+
+    def get_last_message_time(self, chat_id: int) -> Optional[int]:
+        self._flush_chat(chat_id)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT timestamp FROM participant_messages WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 1', (chat_id,))
+            result = cursor.fetchone()
+            if not result:
+                cursor.execute('SELECT started_at FROM game_sessions WHERE chat_id = ? AND is_active = 1', (chat_id,))
+                result = cursor.fetchone()
+            return result[0] if result else None
+
+    # ========== БЭКАПЫ ==========
+
+    def backup_snapshot(self, dest_dir: str, name: str) -> List[str]:
+        """Консистентный снимок базы через SQLite online backup API. Возвращает пути файлов."""
+        self.flush()
+        dest_path = os.path.join(dest_dir, f"{name}.db")
+        dest = sqlite3.connect(dest_path)
+        try:
+            with self.connection() as conn:
+                conn.backup(dest)
+            # Отметки берем из самого снимка, чтобы не потерять строки, вставленные после него
+            self._pending_backup_marks = {
+                table: dest.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                for table in INCREMENTAL_BACKUP_TABLES
+            }
+            self._pending_backup_marks[FULL_BACKUP_MARK] = now_ms()
+        finally:
+            dest.close()
+        return [dest_path]
+
+    def export_changes(self) -> Dict:
+        """Изменения с последнего бэкапа: новые строки append-only таблиц, назначенные им game_id и текущие сессии/участники"""
+        self.flush()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # Все чтения из одного снимка базы
+            cursor.execute('BEGIN')
+            marks = dict(cursor.execute('SELECT table_name, last_id FROM backup_state').fetchall())
+            
+            payload = {'tables': {}, 'new_rows': 0}
+            new_marks = {}
+            for table in INCREMENTAL_BACKUP_TABLES:
+                since_id = marks.get(table, 0)
+                cursor.execute(f'SELECT * FROM {table} WHERE id > ? ORDER BY id', (since_id,))
+                columns = [d[0] for d in cursor.description]
+                rows = cursor.fetchall()
+                payload['tables'][table] = {'since_id': since_id, 'columns': columns, 'rows': rows}
+                payload['new_rows'] += len(rows)
+                new_marks[table] = rows[-1][columns.index('id')] if rows else since_id
+            
+            # Реплики, вытесненные из окна до прошлого бэкапа, попали в него с game_id = NULL;
+            # _archive_game проставил им game_id позже - переносим это назначение (id, game_id)
+            cursor.execute('''
+                SELECT id, game_id FROM archived_conversation
+                WHERE game_id IN (SELECT id FROM archived_games WHERE id > ?) AND id <= ?
+                ORDER BY id
+            ''', (marks.get('archived_games', 0), marks.get('archived_conversation', 0)))
+            payload['tables']['archived_conversation']['assigned'] = cursor.fetchall()
+            
+            for table in SNAPSHOT_BACKUP_TABLES:
+                cursor.execute(f'SELECT * FROM {table}')
+                columns = [d[0] for d in cursor.description]
+                payload['tables'][table] = {'columns': columns, 'rows': cursor.fetchall()}
+        
+        self._pending_backup_marks = new_marks
+        return payload
+
+    def commit_backup(self):
+        """Запомнить отметки последнего снимка/экспорта (вызывать после успешной отправки)"""
+        if not self._pending_backup_marks:
+            return
+        with self.connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO backup_state (table_name, last_id) VALUES (?, ?)',
+                self._pending_backup_marks.items()
+            )
+            conn.commit()
+        self._pending_backup_marks = None
+
+    def last_full_backup_at(self) -> Optional[int]:
+        with self.connection() as conn:
+            row = conn.execute('SELECT last_id FROM backup_state WHERE table_name = ?', (FULL_BACKUP_MARK,)).fetchone()
+        return row[0] if row else None
+
+    def get_storage_stats(self) -> Dict:
+        """Сводка по объему данных (для админки и мониторинга)"""
+        self.flush()
+        with self.connection() as conn:
+            row = conn.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM game_sessions WHERE is_active = 1),
+                    (SELECT COUNT(*) FROM participant_messages),
+                    (SELECT COUNT(*) FROM conversation_history),
+                    (SELECT COUNT(*) FROM archived_games)
+            ''').fetchone()
+        return {'active_games': row[0], 'live_messages': row[1], 'live_conversation': row[2], 'archived_games': row[3]}
+
+
+class ShardedDatabase(StorageBackend):
+    """SQLite, разбитый по chat_id на несколько файлов.
+
+    SQLite допускает только одного писателя на файл, поэтому чаты
+    раскладываются по DB_SHARDS файлам, у каждого свой пул соединений и свой
+    буфер записи. Все данные одного чата живут в одном шарде, так что API
+    Database не меняется. Админские операции (бэкапы, чистка архива,
+    статистика) обходят все шарды.
+    """
+
+    supports_backup = True
+
+    def __init__(self, shard_count: int, db_name: Optional[str] = None):
+        base, ext = os.path.splitext(db_name or config.DB_NAME)
+        self.shards = [Database(f"{base}.shard{i}{ext}") for i in range(shard_count)]
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.shards)
+
+    def shard_for(self, chat_id: int) -> Database:
+        # % в Python всегда неотрицательный, отрицательные id групп тоже распределяются
+        return self.shards[chat_id % len(self.shards)]
+
+    # ----- Операции одного чата -----
+
+    def init_game_session(self, chat_id: int, initiator_id: int, difficulty: str = "hard"):
+        self.shard_for(chat_id).init_game_session(chat_id, initiator_id, difficulty)
+
+    def set_game_started(self, chat_id: int):
+        self.shard_for(chat_id).set_game_started(chat_id)
+
+    def get_game_info(self, chat_id: int) -> Optional[GameInfo]:
+        return self.shard_for(chat_id).get_game_info(chat_id)
+
+    def end_game(self, chat_id: int, winner_user_id: Optional[int] = None, winner_name: Optional[str] = None):
+        self.shard_for(chat_id).end_game(chat_id, winner_user_id, winner_name)
+
+    def get_game_start_time(self, chat_id: int) -> Optional[int]:
+        return self.shard_for(chat_id).get_game_start_time(chat_id)
+
+    def add_participant(self, chat_id: int, user_id: int, username: str, first_name: str) -> bool:
+        return self.shard_for(chat_id).add_participant(chat_id, user_id, username, first_name)
+
+    def get_registered_participants(self, chat_id: int) -> List[Participant]:
+        return self.shard_for(chat_id).get_registered_participants(chat_id)
+
+    def is_participant(self, chat_id: int, user_id: int) -> bool:
+        return self.shard_for(chat_id).is_participant(chat_id, user_id)
+
+    def record_turn(self, chat_id: int, user_id: int, username: str, first_name: str,
+                    message: str, history_limit: Optional[int] = None) -> Optional[TurnContext]:
+        return self.shard_for(chat_id).record_turn(chat_id, user_id, username, first_name, message, history_limit)
+
+    def add_participant_message(self, chat_id: int, user_id: int, username: str, first_name: str, message: str):
+        self.shard_for(chat_id).add_participant_message(chat_id, user_id, username, first_name, message)
+
+    def get_participant_message_count(self, chat_id: int, user_id: int) -> int:
+        return self.shard_for(chat_id).get_participant_message_count(chat_id, user_id)
+
+    def get_participant_messages(self, chat_id: int, user_id: Optional[int] = None) -> List[ParticipantMessage]:
+        return self.shard_for(chat_id).get_participant_messages(chat_id, user_id)
+
+    def get_recent_messages_per_participant(self, chat_id: int, per_user: int) -> List[ParticipantMessage]:
+        return self.shard_for(chat_id).get_recent_messages_per_participant(chat_id, per_user)
+
+    def get_participants_stats(self, chat_id: int) -> List[Participant]:
+        return self.shard_for(chat_id).get_participants_stats(chat_id)
+
+    def get_last_message_time(self, chat_id: int) -> Optional[int]:
+        return self.shard_for(chat_id).get_last_message_time(chat_id)
+
+    def add_affection(self, chat_id: int, user_id: int, delta: int):
+        self.shard_for(chat_id).add_affection(chat_id, user_id, delta)
+
+    def get_affection_scores(self, chat_id: int) -> List[AffectionScore]:
+        return self.shard_for(chat_id).get_affection_scores(chat_id)
+
+    def add_conversation(self, chat_id: int, role: str, content: str):
+        self.shard_for(chat_id).add_conversation(chat_id, role, content)
+
+    def get_conversation_history(self, chat_id: int, limit: Optional[int] = None) -> List[ConversationTurn]:
+        return self.shard_for(chat_id).get_conversation_history(chat_id, limit)
+
+    # ----- Операции по всем шардам -----
+
+    def prune_archive(self, retention_days: int, vacuum_pages: int) -> int:
+        return sum(shard.prune_archive(retention_days, vacuum_pages) for shard in self.shards)
+
+    def backup_snapshot(self, dest_dir: str, name: str) -> List[str]:
+        paths = []
+        for i, shard in enumerate(self.shards):
+            paths.extend(shard.backup_snapshot(dest_dir, f"{name}.shard{i}"))
+        return paths
+
+    def export_changes(self) -> Dict:
+        shards = [shard.export_changes() for shard in self.shards]
+        return {'shards': shards, 'new_rows': sum(c['new_rows'] for c in shards)}
+
+    def commit_backup(self):
+        for shard in self.shards:
+            shard.commit_backup()
+
+    def last_full_backup_at(self) -> Optional[int]:
+        # Полный бэкап снимает все шарды сразу; если хоть у одного его нет - считаем, что нет
+        marks = [shard.last_full_backup_at() for shard in self.shards]
+        return None if None in marks else min(marks)
+
+    def get_storage_stats(self) -> Dict:
+        totals = {}
+        for shard in self.shards:
+            for key, value in shard.get_storage_stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def cache_stats(self) -> Dict:
+        totals = {}
+        for shard in self.shards:
+            for key, value in shard.cache_stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class AsyncDatabase:
+    """Асинхронный фасад над хранилищем (Database или любой StorageBackend).
+
+    Все обращения к SQLite выполняются в отдельном пуле потоков, поэтому
+    fsync и ожидание блокировок не останавливают event loop бота:
+    `await db.get_game_info(chat_id)` вместо `db.get_game_info(chat_id)`.
+    """
+
+    def __init__(self, database: StorageBackend):
+        self._db = database
+        # Не больше потоков, чем соединений в пулах (у каждого шарда свой пул)
+        workers = config.DB_POOL_SIZE * getattr(database, 'shard_count', 1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite")
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+
+        return call
+
+    async def close(self):
+        """Дождаться текущих запросов и закрыть соединения"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._db.close)
+        self._executor.shutdown(wait=True)
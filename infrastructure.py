@@ -1,70 +1,174 @@
-import logging
-import threading
-import asyncio
-import aiohttp
-import os
-import datetime
-from flask import Flask
-from telegram.ext import ContextTypes
-import config
-
-# Настройка логгера
-logger = logging.getLogger(__name__)
-
-# Инициализация Flask
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "Bot is running!", 200
-
-@app.route('/ping')
-def ping():
-    return "pong", 200
-
-def run_web_server():
-    """Запускает Flask сервер в отдельном потоке"""
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
-
-def start_server():
-    t = threading.Thread(target=run_web_server, daemon=True)
-    t.start()
-
-# ========== ЗАДАЧИ JOB QUEUE ==========
-
-async def self_ping(context: ContextTypes.DEFAULT_TYPE):
-    """Пингует сам себя, чтобы Render не уснул"""
-    url = f"{config.RENDER_APP_URL}/ping"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                logger.info(f"Self-ping status: {resp.status}")
-    except Exception as e:
-        logger.error(f"Self-ping error: {e}")
-
-async def backup_database(context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет файл базы данных в чат для бэкапов"""
-    chat_id = config.BACKUP_CHAT_ID
-    db_path = config.DB_NAME
-    
-    if not chat_id:
-        logger.warning("BACKUP_CHAT_ID not set in config.")
-        return
-
-    if not os.path.exists(db_path):
-        logger.error(f"Database file {db_path} not found!")
-        return
-
-    try:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(db_path, 'rb') as f:
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=f,
-                caption=f"📦 Автоматический бэкап базы данных\n📅 {now}",
-                disable_notification=True
-            )
-        logger.info("Database backup sent successfully.")
-    except Exception as e:
-        logger.error(f"Error sending backup: {e}")
\ No newline at end of file
+import logging
+import threading
+import asyncio
+import aiohttp
+import os
+import datetime
+import gzip
+import json
+import tarfile
+import tempfile
+import time
+from typing import List
+from flask import Flask
+from telegram.ext import ContextTypes
+import config
+
+# Настройка логгера
+logger = logging.getLogger(__name__)
+
+# Инициализация Flask
+app = Flask(__name__)
+
+@app.route('/')
+def home():
+    return "Bot is running!", 200
+
+@app.route('/ping')
+def ping():
+    return "pong", 200
+
+def run_web_server():
+    """Запускает Flask сервер в отдельном потоке"""
+    port = int(os.environ.get("PORT", 8080))
+    app.run(host="0.0.0.0", port=port)
+
+def start_server():
+    t = threading.Thread(target=run_web_server, daemon=True)
+    t.start()
+
+# ========== ЗАДАЧИ JOB QUEUE ==========
+
+async def prune_archive(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет старые архивные игры и понемногу возвращает место в файле БД"""
+    db = context.job.data
+    try:
+        await db.prune_archive(config.ARCHIVE_RETENTION_DAYS, config.ARCHIVE_VACUUM_PAGES)
+    except Exception as e:
+        logger.error(f"Archive prune error: {e}")
+
+async def self_ping(context: ContextTypes.DEFAULT_TYPE):
+    """Пингует сам себя, чтобы Render не уснул"""
+    url = f"{config.RENDER_APP_URL}/ping"
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                logger.info(f"Self-ping status: {resp.status}")
+    except Exception as e:
+        logger.error(f"Self-ping error: {e}")
+
+def _discard_backup(archive_path: str):
+    """Удаляет неотправленный архив и его части"""
+    if not os.path.isdir(config.BACKUP_DIR):
+        return
+    name = os.path.basename(archive_path)
+    for f in os.listdir(config.BACKUP_DIR):
+        if f == name or f.startswith(f"{name}.part"):
+            os.remove(os.path.join(config.BACKUP_DIR, f))
+
+def _compress(src_paths: List[str], dest_path: str):
+    """Сжимает один или несколько файлов в tar.gz"""
+    with tarfile.open(dest_path, 'w:gz') as tar:
+        for path in src_paths:
+            tar.add(path, arcname=os.path.basename(path))
+
+def _write_json_gz(payload: dict, dest_path: str):
+    with gzip.open(dest_path, 'wt', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+
+def _split(path: str, chunk_size: int) -> List[str]:
+    """Режет файл на части не больше chunk_size (склеить: cat file.part* > file)"""
+    if os.path.getsize(path) <= chunk_size:
+        return [path]
+    parts = []
+    with open(path, 'rb') as src:
+        index = 1
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            part_path = f"{path}.part{index:03d}"
+            with open(part_path, 'wb') as dst:
+                dst.write(chunk)
+            parts.append(part_path)
+            index += 1
+    return parts
+
+def _rotate_backups():
+    """Оставляет BACKUP_KEEP последних бэкапов, но никогда не удаляет последний полный"""
+    archives = sorted(
+        (os.path.join(config.BACKUP_DIR, f) for f in os.listdir(config.BACKUP_DIR) if '.part' not in f),
+        key=os.path.getmtime,
+        reverse=True
+    )
+    fulls = [a for a in archives if '-full-' in a]
+    latest_full = fulls[0] if fulls else None
+    for path in archives[config.BACKUP_KEEP:]:
+        if path != latest_full:
+            os.remove(path)
+
+async def backup_database(context: ContextTypes.DEFAULT_TYPE):
+    """Сжатый бэкап базы в чат для бэкапов.
+
+    Раз в BACKUP_FULL_EVERY_DAYS - полный консистентный снимок (SQLite backup API),
+    в остальные дни - только изменения с прошлого бэкапа. Файлы больше лимита
+    загрузки режутся на части. База передается через data задачи (AsyncDatabase).
+    """
+    chat_id = config.BACKUP_CHAT_ID
+    db = context.job.data
+    
+    if not chat_id:
+        logger.warning("BACKUP_CHAT_ID not set in config.")
+        return
+    if not db.supports_backup:
+        logger.info("Storage backend does not support backups, skipping.")
+        return
+
+    archive_path = None
+    try:
+        os.makedirs(config.BACKUP_DIR, exist_ok=True)
+        now = datetime.datetime.now()
+        stamp = now.strftime("%Y%m%d-%H%M%S")
+        
+        # Считаем от последнего доставленного полного бэкапа, а не от локального файла
+        last_full = await db.last_full_backup_at()
+        is_full = last_full is None or (time.time() * 1000 - last_full) / 86400000 >= config.BACKUP_FULL_EVERY_DAYS
+        
+        if is_full:
+            archive_path = os.path.join(config.BACKUP_DIR, f"bot_data-full-{stamp}.tar.gz")
+            with tempfile.TemporaryDirectory() as tmp:
+                # Снимок и сжатие выполняются вне event loop
+                snapshot_paths = await db.backup_snapshot(tmp, f"bot_data-{stamp}")
+                await asyncio.to_thread(_compress, snapshot_paths, archive_path)
+            kind = "Полный бэкап"
+        else:
+            changes = await db.export_changes()
+            if not changes['new_rows']:
+                logger.info("No new rows since last backup, skipping incremental backup.")
+                return
+            archive_path = os.path.join(config.BACKUP_DIR, f"bot_data-incr-{stamp}.json.gz")
+            await asyncio.to_thread(_write_json_gz, changes, archive_path)
+            kind = f"Инкрементальный бэкап ({changes['new_rows']} новых строк)"
+        
+        parts = await asyncio.to_thread(_split, archive_path, config.BACKUP_CHUNK_SIZE)
+        for index, part in enumerate(parts, start=1):
+            part_caption = f"\n🧩 Часть {index}/{len(parts)}" if len(parts) > 1 else ""
+            with open(part, 'rb') as f:
+                await context.bot.send_document(
+                    chat_id=chat_id,
+                    document=f,
+                    caption=f"📦 {kind}\n📅 {now.strftime('%Y-%m-%d %H:%M:%S')}{part_caption}",
+                    disable_notification=True
+                )
+            if part != archive_path:
+                os.remove(part)
+        
+        # Отметки сохраняем только после успешной отправки всех частей
+        await db.commit_backup()
+        await asyncio.to_thread(_rotate_backups)
+        logger.info(f"Database backup sent successfully ({'full' if is_full else 'incremental'}, {len(parts)} part(s)).")
+    except Exception as e:
+        logger.error(f"Error sending backup: {e}")
+        # Недоставленный архив не должен оставаться на диске
+        if archive_path:
+            await asyncio.to_thread(_discard_backup, archive_path)
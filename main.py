@@ -1,6 +1,7 @@
 import logging
 import asyncio
-from datetime import datetime, timedelta, timezone
+import time
+from typing import Optional, Dict, List
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, 
@@ -13,8 +14,10 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 
 import config
-from database import Database
+from database import AsyncDatabase
+from storage import create_storage, now_ms
 from ai_handler import AIHandler
+from models import Participant, AffectionScore
 import infrastructure
 
 # Настройка логирования
@@ -25,7 +28,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация
-db = Database()
+db = AsyncDatabase(create_storage())
 ai = AIHandler()
 
 # Глобальные переменные для отслеживания игр
@@ -35,6 +38,10 @@ active_games = {}
 # Блокировки для чатов
 chat_locks = {}
 
+# Режим склейки: чаты, где AI сейчас отвечает, и сообщения, ждущие общего ответа
+replying_chats = set()
+pending_messages = {}
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help - справка в стиле Алисы"""
     help_text = (
@@ -90,7 +97,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if db.is_game_active(chat_id):
+    if await db.is_game_active(chat_id):
         await update.message.reply_text(
             f"Игра уже идет! Не тупи 🙄\n"
             f"Пиши мне сообщения, используй {config.COMMAND_PREFIX} или просто отвечай на мои сообщения."
@@ -132,11 +139,11 @@ async def difficulty_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Инициализируем Лобби в БД
     chat_id = update.effective_chat.id
-    db.init_game_session(chat_id, initiator_id, difficulty)
+    await db.init_game_session(chat_id, initiator_id, difficulty)
     
     # Добавляем инициатора сразу как участника
     user = query.from_user
-    db.add_participant(chat_id, user.id, user.username, user.first_name)
+    await db.add_participant(chat_id, user.id, user.username, user.first_name)
     
     if config.MAX_PLAYERS_PER_GAME == 1:
         diff_text = {"easy": "😇 Легкая", "medium": "😐 Средняя", "hard": "👿 Сложная"}.get(difficulty, difficulty)
@@ -166,7 +173,7 @@ async def difficulty_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def update_lobby_message(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, difficulty: str, initiator_id: int, is_auto_start=False):
     """Обновляет сообщение лобби (или отправляет новое)"""
-    participants = db.get_registered_participants(chat_id)
+    participants = await db.get_registered_participants(chat_id)
     count = len(participants)
     max_players = config.MAX_PLAYERS_PER_GAME
     
@@ -174,15 +181,15 @@ async def update_lobby_message(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Формируем список с ссылками (tg://openmessage)
     participants_list_text = "\n".join([
-        f"- <a href='tg://openmessage?user_id={p['user_id']}'>{p['first_name']}</a>" 
+        f"- <a href='tg://openmessage?user_id={p.user_id}'>{p.first_name}</a>" 
         for p in participants
     ])
 
     # Определяем имя инициатора из списка участников
     initiator_name = "Неизвестный"
     for p in participants:
-        if p['user_id'] == initiator_id:
-            initiator_name = p['first_name']
+        if p.user_id == initiator_id:
+            initiator_name = p.first_name
             break
     
     text = (
@@ -236,8 +243,8 @@ async def lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     
     # Проверяем статус игры (должен быть waiting)
-    game_info = db.get_game_info(chat_id)
-    if not game_info or game_info['status'] != 'waiting':
+    game_info = await db.get_game_info(chat_id)
+    if not game_info or game_info.status != 'waiting':
         await query.answer("Игра уже началась или была отменена!", show_alert=True)
         try:
             await query.edit_message_reply_markup(None)
@@ -247,7 +254,7 @@ async def lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if action == "join":
         # Попытка добавить участника
-        success = db.add_participant(chat_id, user.id, user.username, user.first_name)
+        success = await db.add_participant(chat_id, user.id, user.username, user.first_name)
         
         if not success:
             # Пользователь уже в базе
@@ -257,14 +264,14 @@ async def lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Ты в игре!")
         
         # Проверяем, набрался ли фулл
-        participants = db.get_registered_participants(chat_id)
+        participants = await db.get_registered_participants(chat_id)
         if len(participants) >= config.MAX_PLAYERS_PER_GAME:
             # --- Авто-старт ---
-            await update_lobby_message(update, context, chat_id, game_info['difficulty'], game_info['initiator_id'], is_auto_start=True)
-            await start_game_logic(chat_id, context, game_info['difficulty'])
+            await update_lobby_message(update, context, chat_id, game_info.difficulty, game_info.initiator_id, is_auto_start=True)
+            await start_game_logic(chat_id, context, game_info.difficulty)
         else:
             # Обновляем сообщение лобби
-            await update_lobby_message(update, context, chat_id, game_info['difficulty'], game_info['initiator_id'])
+            await update_lobby_message(update, context, chat_id, game_info.difficulty, game_info.initiator_id)
 
     elif action == "start":
         initiator_id = int(data[2])
@@ -274,7 +281,7 @@ async def lobby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await query.answer("Погнали!")
         await query.edit_message_reply_markup(None) # Удаляем кнопки
-        await start_game_logic(chat_id, context, game_info['difficulty'])
+        await start_game_logic(chat_id, context, game_info.difficulty)
         
     elif action == "cancel":
         initiator_id = int(data[2])
@@ -298,7 +305,7 @@ async def cancel_lobby(context: ContextTypes.DEFAULT_TYPE, chat_id: int, reason:
         del active_games[chat_id]
         
     # Обновляем БД (завершаем сессию)
-    db.end_game(chat_id)
+    await db.end_game(chat_id)
     
     text = f"🚫 <b>Набор игроков отменен.</b>\nПричина: {reason}"
     
@@ -330,8 +337,8 @@ async def check_lobby_timeout(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         await asyncio.sleep(config.CHECK_INTERVAL)
         
         # Если мы здесь, значит игра все еще в статусе ожидания
-        game_info = db.get_game_info(chat_id)
-        if game_info and game_info['status'] == 'waiting':
+        game_info = await db.get_game_info(chat_id)
+        if game_info and game_info.status == 'waiting':
              # Вызываем отмену с редактированием сообщения
              await cancel_lobby(context, chat_id, f"Истекло время ожидания ({int(config.CHECK_INTERVAL/60)} мин).")
              
@@ -352,7 +359,7 @@ async def start_game_logic(chat_id: int, context: ContextTypes.DEFAULT_TYPE, dif
         del active_games[chat_id]
     
     # Переводим статус в playing
-    db.set_game_started(chat_id)
+    await db.set_game_started(chat_id)
     
     # Тексты интро
     if difficulty == "easy":
@@ -437,8 +444,9 @@ async def start_game_logic(chat_id: int, context: ContextTypes.DEFAULT_TYPE, dif
 
     await context.bot.send_message(chat_id, intro_message)
     
-    # Сохраняем в историю
-    db.add_conversation(chat_id, "assistant", intro_message)
+    # Сохраняем в историю; краткое содержание прошлой игры больше не нужно
+    ai.reset_context(chat_id)
+    await db.add_conversation(chat_id, "assistant", intro_message)
     
     # Запускаем фоновую проверку игры
     check_task = asyncio.create_task(check_game_progress(context, chat_id))
@@ -449,6 +457,48 @@ async def start_game_logic(chat_id: int, context: ContextTypes.DEFAULT_TYPE, dif
     
     logger.info(f"Game started in chat {chat_id} with difficulty {difficulty}")
 
+def streaming_reply(update: Update):
+    """Постепенный вывод ответа AI: первое сообщение, затем правки не чаще STREAM_EDIT_INTERVAL.
+
+    Возвращает (on_delta, finish). finish(text) доводит сообщение до итогового текста
+    (или удаляет, если text пустой) и возвращает True, если ответ уже в чате.
+    """
+    sent = None
+    shown = ""
+    last_edit = 0.0
+
+    async def on_delta(text: str):
+        nonlocal sent, shown, last_edit
+        if len(text) < config.STREAM_MIN_CHARS or text == shown:
+            return
+        now = time.monotonic()
+        if sent and now - last_edit < config.STREAM_EDIT_INTERVAL:
+            return
+        try:
+            if sent is None:
+                sent = await update.message.reply_text(text)
+            else:
+                await sent.edit_text(text)
+            shown, last_edit = text, now
+        except Exception as e:
+            logger.warning(f"Streaming update failed: {e}")
+
+    async def finish(text: Optional[str]) -> bool:
+        if sent is None:
+            return False
+        try:
+            if not text:
+                await sent.delete()
+            elif text != shown:
+                await sent.edit_text(text)
+        except Exception as e:
+            # В чате остался бы обрезанный ответ; пусть полный уйдет отдельным сообщением
+            logger.warning(f"Streaming finish failed: {e}")
+            return False
+        return bool(text)
+
+    return on_delta, finish
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка сообщений"""
     if not update.message or not update.message.text:
@@ -462,10 +512,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     message_text = update.message.text
-    user = update.effective_user
-    user_id = user.id
-    username = user.username or ""
-    first_name = user.first_name or "Аноним"
     
     # --- ЛОГИКА ТРИГГЕРОВ СТАРТА ---
     is_trigger = False
@@ -475,7 +521,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             is_trigger = True
             break
             
-    is_game_active = db.is_game_active(chat_id)
+    game_info = await db.get_game_info(chat_id)
+    is_game_active = game_info is not None
     
     # Если это триггер и игра НЕ идет -> запускаем меню старта
     if is_trigger and not is_game_active:
@@ -488,8 +535,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Если игра идет:
     # Если игра в статусе Waiting (Лобби), игнорируем текстовые сообщения
-    game_info = db.get_game_info(chat_id)
-    if game_info and game_info['status'] == 'waiting':
+    if game_info.status == 'waiting':
         return
     
     # Определяем, обращение ли это к боту
@@ -509,77 +555,150 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not should_process:
         return
     
+    if config.AI_COALESCE:
+        await coalesce_message(update, context, chat_id, message_text)
+        return
+    
     # Создаем или получаем лок для чата
     if chat_id not in chat_locks:
         chat_locks[chat_id] = asyncio.Lock()
 
     async with chat_locks[chat_id]:
-        # Снова проверяем активность игры (на случай гонки)
-        if not db.is_game_active(chat_id):
+        # Одной транзакцией: проверка игры и участника (с авто-входом),
+        # запись сообщения и весь контекст для AI
+        turn = await record_message(update, chat_id, message_text)
+        if not turn:
             return
+        
+        await answer_messages(context, chat_id, [pending_message(update, turn, message_text)], turn.conversation_history)
 
-        # --- ПРОВЕРКА УЧАСТНИКА И АВТО-ВХОД ---
-        if not db.is_participant(chat_id, user_id):
-            # Проверяем количество мест
-            participants = db.get_registered_participants(chat_id)
-            if len(participants) < config.MAX_PLAYERS_PER_GAME:
-                # Место есть - добавляем автоматически
-                db.add_participant(chat_id, user_id, username, first_name)
-            else:
-                # Мест нет - отшиваем
-                await update.message.reply_text(
-                    f"🚫 {first_name}, мест в игре больше нет! Жди следующей игры."
-                )
-                return
+async def record_message(update: Update, chat_id: int, message_text: str):
+    """Записывает сообщение участника. None - отвечать не нужно (нет игры или мест)"""
+    user = update.effective_user
+    first_name = user.first_name or "Аноним"
+    turn = await db.record_turn(chat_id, user.id, user.username or "", first_name, message_text)
+    
+    # Снова проверяем активность игры (на случай гонки)
+    if not turn:
+        return None
 
-        # Если участник (или только что стал им), обрабатываем сообщение
-        db.add_participant_message(chat_id, user_id, username, first_name, message_text)
-        
-        conversation_history = db.get_conversation_history(chat_id)
-        participant_messages = db.get_participant_messages(chat_id, user_id)
-        participants_stats = db.get_participants_stats(chat_id)
-        
-        difficulty = db.get_game_difficulty(chat_id)
-        
-        user_display_name = f"{first_name}" + (f" (@{username})" if username else "")
-        
-        # Запрос к AI
-        ai_response = await ai.get_response(
-            message_text,
-            conversation_history,
-            user_display_name,
-            len(participant_messages),
-            participants_stats, 
-            difficulty
+    if not turn.is_participant:
+        # Мест нет - отшиваем
+        await update.message.reply_text(
+            f"🚫 {first_name}, мест в игре больше нет! Жди следующей игры."
         )
+        return None
+    return turn
 
-        # --- ОБРАБОТКА ОШИБКИ ЛИМИТОВ API ---
-        if ai_response == "SYSTEM_OVERLOAD_LIMITS":
-            await context.bot.send_message(
-                chat_id, 
-                "⚠️ <b>СИСТЕМНЫЙ СБОЙ</b>\n\nМои нейронные сети перегрелись (достигнут дневной лимит API). Я вынуждена уйти спать. Приходите завтра! 😴",
-                parse_mode=ParseMode.HTML
-            )
-            db.end_game(chat_id)
-            if chat_id in active_games:
-                active_games[chat_id]['task'].cancel()
-                del active_games[chat_id]
-            return
-        
-        if ai_response.strip() == "ИГНОР":
-            return
-        
-        db.add_conversation(chat_id, "user", f"{user_display_name}: {message_text}")
-        db.add_conversation(chat_id, "assistant", ai_response)
-        
+def pending_message(update: Update, turn, message_text: str) -> Dict:
+    """Сообщение, ждущее ответа AI"""
+    user = update.effective_user
+    first_name = user.first_name or "Аноним"
+    return {
+        'update': update,
+        'user_id': user.id,
+        'first_name': first_name,
+        'display_name': f"{first_name}" + (f" (@{user.username})" if user.username else ""),
+        'text': message_text,
+        'count': turn.user_messages_count,
+        'turn': turn
+    }
+
+async def coalesce_message(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_text: str):
+    """Режим склейки: пока AI отвечает в чате, новые обращения копятся
+    и получают один общий ответ следующим запросом"""
+    turn = await record_message(update, chat_id, message_text)
+    if not turn:
+        return
+    
+    # Между проверкой и постановкой в очередь нет await: отвечающий не может уйти незаметно
+    message = pending_message(update, turn, message_text)
+    if chat_id in replying_chats:
+        pending_messages.setdefault(chat_id, []).append(message)
+        return
+    
+    replying_chats.add(chat_id)
+    try:
+        batch = [message]
+        while batch:
+            try:
+                if not await db.is_game_active(chat_id):
+                    break
+                # История могла измениться, пока сообщения ждали
+                history = await db.get_conversation_history(chat_id)
+                if not await answer_messages(context, chat_id, batch, history):
+                    break
+            except Exception as e:
+                # Сбой одного ответа не должен терять сообщения, которые ждут следующего
+                logger.error(f"Error answering messages in chat {chat_id}: {e}")
+            # Обработчики идут параллельно и записывают сообщения в разном порядке,
+            # поэтому порядок поступления восстанавливаем по message_id (растет в чате)
+            batch = sorted(pending_messages.pop(chat_id, []), key=lambda m: m['update'].message.message_id)
+    finally:
+        replying_chats.discard(chat_id)
+        # Сюда с непустой очередью приходим только когда игра закончилась (или задачу отменили)
+        pending_messages.pop(chat_id, None)
+
+async def answer_messages(context: ContextTypes.DEFAULT_TYPE, chat_id: int, messages: List[Dict], history) -> bool:
+    """Один ответ AI на сообщения (последнее - то, на которое отвечаем).
+    Возвращает False, если игра закончилась."""
+    last = messages[-1]
+    update, user_id, turn = last['update'], last['user_id'], last['turn']
+    
+    # Запрос к AI (в режиме стриминга ответ появляется в чате по мере генерации)
+    on_delta, finish_stream = streaming_reply(update) if config.AI_STREAMING else (None, None)
+    reply = await ai.get_response(
+        last['text'],
+        history,
+        last['display_name'],
+        last['count'],
+        turn.participants_stats, 
+        turn.difficulty,
+        chat_id=chat_id,
+        on_delta=on_delta,
+        queued=[ai.format_user_message(m['display_name'], m['count'], m['text']) for m in messages[:-1]]
+    )
+    ai_response = reply.text
+
+    # --- ОБРАБОТКА ОШИБКИ ЛИМИТОВ API ---
+    if ai_response == "SYSTEM_OVERLOAD_LIMITS":
+        if finish_stream:
+            await finish_stream(None)
+        await context.bot.send_message(
+            chat_id, 
+            "⚠️ <b>СИСТЕМНЫЙ СБОЙ</b>\n\nМои нейронные сети перегрелись (достигнут дневной лимит API). Я вынуждена уйти спать. Приходите завтра! 😴",
+            parse_mode=ParseMode.HTML
+        )
+        await db.end_game(chat_id)
+        if chat_id in active_games:
+            active_games[chat_id]['task'].cancel()
+            del active_games[chat_id]
+        return False
+    
+    # Оценка хода копится и при игноре: хамство тоже влияет на счет. Метка одна на
+    # ответ, и в общем ответе на несколько сообщений неясно, к чьему ходу она относится
+    if reply.affection and len(messages) == 1:
+        await db.add_affection(chat_id, user_id, reply.affection)
+    
+    if ai_response.strip() == "ИГНОР":
+        if finish_stream:
+            await finish_stream(None)
+        return True
+    
+    for m in messages:
+        await db.add_conversation(chat_id, "user", f"{m['display_name']}: {m['text']}")
+    await db.add_conversation(chat_id, "assistant", ai_response)
+    
+    if not (finish_stream and await finish_stream(ai_response)):
         await update.message.reply_text(ai_response)
 
-        # --- ПРОВЕРКА ПОБЕДЫ ---
-        if "я в тебя влюбилась" in ai_response.lower() and "хочу быть с тобой" in ai_response.lower():
-            
-            winner_display = f"{first_name}" + (f" (@{username})" if username else "")
-            
-            system_msg = f"""💕 ИГРА ОКОНЧЕНА! 💕
+    # --- ПРОВЕРКА ПОБЕДЫ ---
+    if "я в тебя влюбилась" in ai_response.lower() and "хочу быть с тобой" in ai_response.lower():
+        # В общем ответе признание может быть адресовано не последнему автору
+        winner = next((m for m in reversed(messages) if m['first_name'].lower() in ai_response.lower()), last)
+        winner_display = winner['display_name']
+        
+        system_msg = f"""💕 ИГРА ОКОНЧЕНА! 💕
 
 Всё... я влюбилась. Да, блять, ВЛЮБИЛАСЬ! Не могу поверить сама 😳
 
@@ -591,42 +710,34 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Чтобы начать новую игру, напишите /start, /alisa или "Алиса приходи"."""
 
-            await context.bot.send_message(chat_id, system_msg)
-            db.end_game(chat_id, user_id, winner_display)
-            if chat_id in active_games:
-                active_games[chat_id]['task'].cancel()
-                del active_games[chat_id]
-            return
+        await context.bot.send_message(chat_id, system_msg)
+        await db.end_game(chat_id, winner['user_id'], winner_display)
+        if chat_id in active_games:
+            active_games[chat_id]['task'].cancel()
+            del active_games[chat_id]
+        return False
+    return True
 
 async def check_game_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Фоновая задача для проверки прогресса игры и тайм-аута"""
     try:
-        while db.is_game_active(chat_id):
+        while await db.is_game_active(chat_id):
             await asyncio.sleep(config.CHECK_INTERVAL)
             
-            if not db.is_game_playing(chat_id):
+            if not await db.is_game_playing(chat_id):
                  continue
 
-            if not db.is_game_active(chat_id):
+            if not await db.is_game_active(chat_id):
                 break
             
-            difficulty = db.get_game_difficulty(chat_id)
+            difficulty = await db.get_game_difficulty(chat_id)
             
             # --- ПРОВЕРКА НА БЕЗДЕЙСТВИЕ (INACTIVITY) ---
-            last_msg_time_str = db.get_last_message_time(chat_id)
+            # Время в хранилище - миллисекунды Unix epoch (UTC), парсить ничего не нужно
+            last_msg_time = await db.get_last_message_time(chat_id)
             
-            if last_msg_time_str:
-                # В БД (SQLite CURRENT_TIMESTAMP) время в UTC. 
-                # datetime.now() возвращает локальное время сервера.
-                # Используем timezone.utc для корректного сравнения.
-                
-                # Парсим время из БД как UTC-aware
-                last_msg_time = datetime.fromisoformat(last_msg_time_str).replace(tzinfo=timezone.utc)
-                
-                # Текущее время тоже в UTC-aware
-                now_utc = datetime.now(timezone.utc)
-                
-                silence_duration = (now_utc - last_msg_time).total_seconds()
+            if last_msg_time:
+                silence_duration = (now_ms() - last_msg_time) / 1000
                 
                 # Завершаем игру если участники молчат больше CHECK_INTERVAL
                 if silence_duration > config.CHECK_INTERVAL + 30:
@@ -634,12 +745,9 @@ async def check_game_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
                     break
             
             # --- ПРОВЕРКА ОБЩЕГО ВРЕМЕНИ ---
-            start_time_str = db.get_game_start_time(chat_id)
-            if start_time_str:
-                start_time = datetime.fromisoformat(start_time_str).replace(tzinfo=timezone.utc)
-                now_utc = datetime.now(timezone.utc)
-                
-                total_elapsed = (now_utc - start_time).total_seconds()
+            start_time = await db.get_game_start_time(chat_id)
+            if start_time:
+                total_elapsed = (now_ms() - start_time) / 1000
                 
                 max_duration = config.get_max_game_duration(difficulty)
                 
@@ -649,10 +757,10 @@ async def check_game_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
                 
                 if total_elapsed >= config.MIN_GAME_DURATION:
                     # Проверка победителя (опционально)
-                    stats = db.get_participants_stats(chat_id)
-                    if len(stats) > 0 and stats[0]['message_count'] >= 3:
+                    stats = await db.get_participants_stats(chat_id)
+                    if len(stats) > 0 and stats[0].message_count >= 3:
                         await check_for_winner(context, chat_id)
-                        if not db.is_game_active(chat_id):
+                        if not await db.is_game_active(chat_id):
                             break
     
     except asyncio.CancelledError:
@@ -660,22 +768,56 @@ async def check_game_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     except Exception as e:
         logger.error(f"Error in check_game_progress for chat {chat_id}: {e}")
 
-async def check_for_winner(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Проверка, есть ли победитель"""
+def affection_verdict(scores: List[AffectionScore], difficulty: str, final: bool = False) -> Optional[Dict]:
+    """Вердикт по счету симпатии в той же форме, что у ai.decide_winner.
+
+    None - решить по счету нельзя (оценок нет, ничья лидеров, а в конце игры еще
+    и счет лидера от половины порога до порога): нужен полный разбор AI.
+    """
+    if not any(s.affection for s in scores):
+        return None
+    threshold = config.AFFECTION_WIN_SCORES.get(difficulty, config.AFFECTION_WIN_SCORES["hard"])
+    leader = scores[0]
+    if leader.affection >= threshold:
+        if len(scores) > 1 and scores[1].affection == leader.affection:
+            return None
+        return {
+            'in_love': True,
+            'winner_user_id': leader.user_id,
+            'winner_name': leader.first_name,
+            'reason': "Ты раз за разом меня цеплял(а), и я сдалась 🙈"
+        }
+    if final and leader.affection * 2 >= threshold:
+        return None
+    return {'in_love': False, 'winner_user_id': None, 'winner_name': None, 'reason': 'Никто не впечатлил меня'}
+
+async def decide_game(chat_id: int, participants: List[Participant], difficulty: str, final: bool = False) -> Optional[Dict]:
+    """Вердикт по счету симпатии, а если по нему решить нельзя - полный разбор AI"""
+    if config.AI_AFFECTION_SCORING:
+        decision = affection_verdict(await db.get_affection_scores(chat_id), difficulty, final)
+        if decision is not None:
+            return decision
+    recent_messages = await db.get_recent_messages_per_participant(chat_id, config.WINNER_MESSAGES_PER_USER)
+    return await ai.decide_winner(participants, recent_messages, difficulty, chat_id=chat_id)
+
+async def check_for_winner(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                           decision: Optional[Dict] = None) -> bool:
+    """Проверка, есть ли победитель. decision - уже полученный вердикт (тогда заново не решаем).
+    Возвращает True, если игра закончилась победой."""
     try:
-        participants = db.get_registered_participants(chat_id)
-        all_messages = db.get_participant_messages(chat_id)
-        difficulty = db.get_game_difficulty(chat_id)
+        participants = await db.get_registered_participants(chat_id)
         
-        decision = await ai.decide_winner(participants, all_messages, difficulty)
+        if decision is None:
+            difficulty = await db.get_game_difficulty(chat_id)
+            decision = await decide_game(chat_id, participants, difficulty)
         
         if decision and decision.get('in_love'):
             winner_id = decision.get('winner_user_id')
             reason = decision.get('reason', '')
             
-            winner = next((p for p in participants if p['user_id'] == winner_id), None)
+            winner = next((p for p in participants if p.user_id == winner_id), None)
             if winner:
-                winner_display = f"{winner['first_name']}" + (f" (@{winner['username']})" if winner['username'] else "")
+                winner_display = f"{winner.first_name}" + (f" (@{winner.username})" if winner.username else "")
                 
                 victory_message = f"""💕 ИГРА ОКОНЧЕНА! 💕
 
@@ -692,14 +834,16 @@ async def check_for_winner(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 Чтобы начать новую игру, напишите /start, /alisa или "Алиса приходи"."""
 
                 await context.bot.send_message(chat_id, victory_message)
-                db.end_game(chat_id, winner_id, winner_display)
+                await db.end_game(chat_id, winner_id, winner_display)
                 if chat_id in active_games:
                     active_games[chat_id]['task'].cancel()
                     del active_games[chat_id]
                 logger.info(f"Game won by {winner_display} in chat {chat_id}")
+                return True
     
     except Exception as e:
         logger.error(f"Error checking for winner in chat {chat_id}: {e}")
+    return False
 
 async def end_game_inactivity(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     try:
@@ -711,7 +855,7 @@ async def end_game_inactivity(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 Игра окончена. Если захотите снова попробовать (и не тупить) — пишите /start, /alisa или "Алиса приходи"."""
 
         await context.bot.send_message(chat_id, inactivity_message)
-        db.end_game(chat_id)
+        await db.end_game(chat_id)
         if chat_id in active_games:
             active_games[chat_id]['task'].cancel()
             del active_games[chat_id]
@@ -722,8 +866,8 @@ async def end_game_inactivity(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 
 async def end_game_timeout(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     try:
-        participants = db.get_registered_participants(chat_id)
-        difficulty = db.get_game_difficulty(chat_id)
+        participants = await db.get_registered_participants(chat_id)
+        difficulty = await db.get_game_difficulty(chat_id)
         
         if len(participants) == 0:
             timeout_message = f"""⏰ ВРЕМЯ ВЫШЛО!
@@ -732,17 +876,20 @@ async def end_game_timeout(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 
 Если хотите попробовать снова — напишите /start, /alisa или "Алиса приходи" 😏"""
             await context.bot.send_message(chat_id, timeout_message)
-            db.end_game(chat_id)
+            await db.end_game(chat_id)
 
         else:
-            all_messages = db.get_participant_messages(chat_id)
-            decision = await ai.decide_winner(participants, all_messages, difficulty)
+            decision = await decide_game(chat_id, participants, difficulty, final=True)
             
-            if decision and decision.get('in_love'):
-                await check_for_winner(context, chat_id)
+            # Вердикт передаем дальше, чтобы не спрашивать AI второй раз
+            if decision and decision.get('in_love') and await check_for_winner(context, chat_id, decision):
                 return
             else:
-                reason = decision.get('reason', 'Никто не впечатлил меня') if decision else 'Никто не впечатлил меня'
+                # Причина влюбленности (победитель не нашелся среди участников) сюда не подходит
+                if decision and not decision.get('in_love'):
+                    reason = decision.get('reason', 'Никто не впечатлил меня')
+                else:
+                    reason = 'Никто не впечатлил меня'
                 timeout_message = f"""⏰ ВРЕМЯ ВЫШЛО!
 
 Всё, ребят, игра окончена. И знаете что? Я ни в кого не влюбилась 💔
@@ -754,7 +901,7 @@ async def end_game_timeout(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 Попробуйте ещё раз, может повезёт — /start, /alisa или "Алиса приходи" 😏"""
         
                 await context.bot.send_message(chat_id, timeout_message)
-                db.end_game(chat_id)
+                await db.end_game(chat_id)
                 
         if chat_id in active_games:
             active_games[chat_id]['task'].cancel()
@@ -764,6 +911,10 @@ async def end_game_timeout(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     except Exception as e:
         logger.error(f"Error ending game by timeout in chat {chat_id}: {e}")
 
+async def startup(application: Application):
+    """Открыть долгоживущие соединения с провайдерами AI"""
+    await ai.start()
+
 async def shutdown(application: Application):
     """Корректное завершение всех задач при остановке бота"""
     logger.info("Shutting down... cancelling active games.")
@@ -772,6 +923,12 @@ async def shutdown(application: Application):
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info(f"Session cache stats: {await db.cache_stats()}")
+    logger.info(f"AI HTTP stats: {ai.http_stats()}")
+    if config.AI_HEDGING:
+        logger.info(f"AI hedging stats: {ai.hedge_summary()}")
+    await ai.close()
+    await db.close()
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}")
@@ -785,6 +942,7 @@ def main():
     
     application = Application.builder()\
         .token(config.TELEGRAM_BOT_TOKEN)\
+        .post_init(startup)\
         .post_shutdown(shutdown)\
         .build()
     
@@ -800,16 +958,21 @@ def main():
     application.add_handler(CallbackQueryHandler(lobby_callback, pattern=r"^lobby\|"))
     
     cmd_name = config.COMMAND_PREFIX.lstrip('/')
-    application.add_handler(CommandHandler(cmd_name, handle_message))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Для склейки сообщения чата должны обрабатываться, пока AI еще отвечает на предыдущее
+    block = not config.AI_COALESCE
+    application.add_handler(CommandHandler(cmd_name, handle_message, block=block))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=block))
     application.add_error_handler(error_handler)
     
     job_queue = application.job_queue
     if config.RENDER_APP_URL:
         job_queue.run_repeating(infrastructure.self_ping, interval=600, first=60)
     
+    # Чистка архива завершенных игр
+    job_queue.run_repeating(infrastructure.prune_archive, interval=config.ARCHIVE_PRUNE_INTERVAL, first=600, data=db)
+    
     # Backup каждые 24 часа (опционально)
-    # job_queue.run_repeating(infrastructure.backup_database, interval=86400, first=3600)
+    # job_queue.run_repeating(infrastructure.backup_database, interval=86400, first=3600, data=db)
     
     logger.info("Bot started!")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
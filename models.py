@@ -0,0 +1,58 @@
+from typing import NamedTuple, List
+
+
+# Записи, которые возвращает хранилище. NamedTuple: неизменяемые, компактные
+# (без __dict__ на каждую строку) и с доступом по атрибутам. Порядок полей
+# совпадает с порядком колонок в SELECT, поэтому строки курсора создаются сразу
+# нужного типа через row_factory.
+
+class GameInfo(NamedTuple):
+    status: str
+    difficulty: str
+    initiator_id: int
+    is_active: int
+
+
+class Participant(NamedTuple):
+    user_id: int
+    username: str
+    first_name: str
+    message_count: int
+
+
+class AffectionScore(NamedTuple):
+    user_id: int
+    username: str
+    first_name: str
+    affection: int
+
+
+class ParticipantMessage(NamedTuple):
+    user_id: int
+    username: str
+    first_name: str
+    message: str
+    timestamp: int
+
+
+class ConversationTurn(NamedTuple):
+    role: str
+    content: str
+    timestamp: int
+
+
+class TurnContext(NamedTuple):
+    """Контекст хода AI, собранный record_turn"""
+    status: str
+    difficulty: str
+    is_participant: bool
+    participants: List[Participant]
+    user_messages_count: int = 0
+    participants_stats: List[Participant] = []
+    conversation_history: List[ConversationTurn] = []
+
+
+def row_factory(record_type):
+    """row_factory для sqlite3: строка курсора сразу становится записью record_type"""
+    make = record_type._make
+    return lambda cursor, row: make(row)
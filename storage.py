@@ -0,0 +1,392 @@
+import threading
+import logging
+import time
+from collections import deque
+from abc import ABC, abstractmethod
+from typing import Optional, List, Dict
+import config
+from models import GameInfo, Participant, AffectionScore, ParticipantMessage, ConversationTurn, TurnContext
+
+logger = logging.getLogger(__name__)
+
+class StorageBackend(ABC):
+    """Интерфейс хранилища игр.
+
+    main.py работает только с этими методами (через AsyncDatabase), поэтому
+    движок выбирается в конфиге: SQLite (Database), SQLite по шардам
+    (ShardedDatabase) или память (MemoryStorage).
+    """
+
+    # Есть ли backup_snapshot/export_changes (задача бэкапа проверяет это заранее)
+    supports_backup = False
+
+    # ========== СЕССИИ ==========
+
+    @abstractmethod
+    def init_game_session(self, chat_id: int, initiator_id: int, difficulty: str = "hard"):
+        """Создать сессию игры в режиме ожидания (Лобби)"""
+
+    @abstractmethod
+    def set_game_started(self, chat_id: int):
+        """Перевести игру в статус 'playing'"""
+
+    @abstractmethod
+    def get_game_info(self, chat_id: int) -> Optional[GameInfo]:
+        """Получить информацию о текущей игре"""
+
+    @abstractmethod
+    def end_game(self, chat_id: int, winner_user_id: Optional[int] = None, winner_name: Optional[str] = None):
+        """Завершить игру и перенести ее данные в архив"""
+
+    @abstractmethod
+    def get_game_start_time(self, chat_id: int) -> Optional[int]:
+        pass
+
+    def is_game_active(self, chat_id: int) -> bool:
+        """Проверить активна ли игра (в любом статусе)"""
+        info = self.get_game_info(chat_id)
+        return info is not None and info.is_active == 1
+
+    def is_game_playing(self, chat_id: int) -> bool:
+        """Проверить, идет ли сам процесс игры (статус playing)"""
+        info = self.get_game_info(chat_id)
+        return info is not None and info.is_active == 1 and info.status == 'playing'
+
+    def get_game_difficulty(self, chat_id: int) -> str:
+        info = self.get_game_info(chat_id)
+        return info.difficulty if info else "hard"
+
+    # ========== УЧАСТНИКИ И СООБЩЕНИЯ ==========
+
+    @abstractmethod
+    def add_participant(self, chat_id: int, user_id: int, username: str, first_name: str) -> bool:
+        """Добавить участника в игру. Возвращает True если добавлен, False если уже был."""
+
+    @abstractmethod
+    def get_registered_participants(self, chat_id: int) -> List[Participant]:
+        """Получить список зарегистрированных участников"""
+
+    @abstractmethod
+    def is_participant(self, chat_id: int, user_id: int) -> bool:
+        """Проверить, является ли пользователь участником"""
+
+    @abstractmethod
+    def record_turn(self, chat_id: int, user_id: int, username: str, first_name: str,
+                    message: str, history_limit: Optional[int] = None) -> Optional[TurnContext]:
+        """Записать сообщение участника и собрать контекст хода AI атомарно"""
+
+    @abstractmethod
+    def add_participant_message(self, chat_id: int, user_id: int, username: str, first_name: str, message: str):
+        pass
+
+    @abstractmethod
+    def get_participant_message_count(self, chat_id: int, user_id: int) -> int:
+        pass
+
+    @abstractmethod
+    def get_participant_messages(self, chat_id: int, user_id: Optional[int] = None) -> List[ParticipantMessage]:
+        pass
+
+    @abstractmethod
+    def get_recent_messages_per_participant(self, chat_id: int, per_user: int) -> List[ParticipantMessage]:
+        """Последние per_user сообщений каждого участника (по участнику, в хронологическом порядке)"""
+
+    @abstractmethod
+    def get_participants_stats(self, chat_id: int) -> List[Participant]:
+        """Статистика сообщений для промпта"""
+
+    @abstractmethod
+    def get_last_message_time(self, chat_id: int) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def add_affection(self, chat_id: int, user_id: int, delta: int):
+        """Изменить счет симпатии участника на delta (оценка AI за ход)"""
+
+    @abstractmethod
+    def get_affection_scores(self, chat_id: int) -> List[AffectionScore]:
+        """Счет симпатии участников, по убыванию"""
+
+    # ========== ИСТОРИЯ РАЗГОВОРА ==========
+
+    @abstractmethod
+    def add_conversation(self, chat_id: int, role: str, content: str):
+        pass
+
+    @abstractmethod
+    def get_conversation_history(self, chat_id: int, limit: Optional[int] = None) -> List[ConversationTurn]:
+        """Последние limit реплик из окна CONVERSATION_WINDOW (по умолчанию все окно)"""
+
+    # ========== ОБСЛУЖИВАНИЕ ==========
+
+    @abstractmethod
+    def prune_archive(self, retention_days: int, vacuum_pages: int) -> int:
+        """Удалить архивные игры старше retention_days"""
+
+    def backup_snapshot(self, dest_dir: str, name: str) -> List[str]:
+        raise NotImplementedError(f"{type(self).__name__} does not support backups")
+
+    def export_changes(self) -> Dict:
+        raise NotImplementedError(f"{type(self).__name__} does not support backups")
+
+    def commit_backup(self):
+        pass
+
+    def last_full_backup_at(self) -> Optional[int]:
+        """Время (мс) последнего успешно отправленного полного бэкапа или None"""
+        return None
+
+    def get_storage_stats(self) -> Dict:
+        return {}
+
+    def cache_stats(self) -> Dict:
+        return {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def now_ms() -> int:
+    """Текущее время в миллисекундах Unix epoch (формат всех временных меток хранилища)"""
+    return int(time.time() * 1000)
+
+
+class MemoryStorage(StorageBackend):
+    """Хранилище целиком в памяти процесса: для тестов и нагрузочных прогонов без дискового I/O"""
+
+    def __init__(self):
+        # RLock: AsyncDatabase вызывает методы из пула потоков
+        self._lock = threading.RLock()
+        self._sessions: Dict[int, Dict] = {}
+        self._participants: Dict[int, Dict[int, Dict]] = {}
+        self._messages: Dict[int, List[ParticipantMessage]] = {}
+        # Окно истории ограничено CONVERSATION_WINDOW, вытесненные реплики ждут архивации игры
+        self._conversation: Dict[int, deque] = {}
+        self._evicted_conversation: Dict[int, List[ConversationTurn]] = {}
+        self._archive: List[Dict] = []
+
+    def init_game_session(self, chat_id: int, initiator_id: int, difficulty: str = "hard"):
+        with self._lock:
+            self._archive_game(chat_id)
+            self._sessions[chat_id] = {
+                'status': 'waiting',
+                'difficulty': difficulty,
+                'initiator_id': initiator_id,
+                'is_active': 1,
+                'started_at': now_ms(),
+                'ended_at': None,
+                'winner_user_id': None,
+                'winner_name': None
+            }
+        logger.info(f"Initialized lobby for chat {chat_id}, difficulty {difficulty}")
+
+    def set_game_started(self, chat_id: int):
+        with self._lock:
+            session = self._active_session(chat_id)
+            if session:
+                session['status'] = 'playing'
+                session['started_at'] = now_ms()
+
+    def _active_session(self, chat_id: int) -> Optional[Dict]:
+        session = self._sessions.get(chat_id)
+        return session if session and session['is_active'] == 1 else None
+
+    def get_game_info(self, chat_id: int) -> Optional[GameInfo]:
+        with self._lock:
+            session = self._active_session(chat_id)
+            if not session:
+                return None
+            return GameInfo(session['status'], session['difficulty'], session['initiator_id'], session['is_active'])
+
+    def end_game(self, chat_id: int, winner_user_id: Optional[int] = None, winner_name: Optional[str] = None):
+        with self._lock:
+            session = self._active_session(chat_id)
+            if session:
+                session.update(is_active=0, ended_at=now_ms(), winner_user_id=winner_user_id, winner_name=winner_name)
+                self._archive_game(chat_id)
+        logger.info(f"Ended game for chat {chat_id}, winner: {winner_name}")
+
+    def _archive_game(self, chat_id: int):
+        participants = self._participants.pop(chat_id, {})
+        messages = self._messages.pop(chat_id, [])
+        conversation = self._evicted_conversation.pop(chat_id, []) + list(self._conversation.pop(chat_id, []))
+        if not participants and not messages and not conversation:
+            return
+        session = self._sessions.get(chat_id, {})
+        self._archive.append({
+            'chat_id': chat_id,
+            'difficulty': session.get('difficulty'),
+            'started_at': session.get('started_at'),
+            'ended_at': session.get('ended_at') or now_ms(),
+            'winner_user_id': session.get('winner_user_id'),
+            'winner_name': session.get('winner_name'),
+            'participants': list(participants.values()),
+            'messages': messages,
+            'conversation': conversation
+        })
+
+    def get_game_start_time(self, chat_id: int) -> Optional[int]:
+        with self._lock:
+            session = self._active_session(chat_id)
+            return session['started_at'] if session else None
+
+    def add_participant(self, chat_id: int, user_id: int, username: str, first_name: str) -> bool:
+        with self._lock:
+            participants = self._participants.setdefault(chat_id, {})
+            if user_id in participants:
+                return False
+            participants[user_id] = {
+                'user_id': user_id,
+                'username': username or "",
+                'first_name': first_name or "Аноним",
+                'message_count': 0,
+                'last_message_at': None,
+                'total_chars': 0,
+                'affection': 0
+            }
+            return True
+
+    def get_registered_participants(self, chat_id: int) -> List[Participant]:
+        with self._lock:
+            return [self._participant_record(p) for p in self._participants.get(chat_id, {}).values()]
+
+    @staticmethod
+    def _participant_record(participant: Dict) -> Participant:
+        return Participant(participant['user_id'], participant['username'], participant['first_name'], participant['message_count'])
+
+    def is_participant(self, chat_id: int, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._participants.get(chat_id, {})
+
+    def record_turn(self, chat_id: int, user_id: int, username: str, first_name: str,
+                    message: str, history_limit: Optional[int] = None) -> Optional[TurnContext]:
+        with self._lock:
+            game_info = self.get_game_info(chat_id)
+            if not game_info:
+                return None
+
+            is_participant = self.is_participant(chat_id, user_id)
+            if not is_participant and len(self._participants.get(chat_id, {})) < config.MAX_PLAYERS_PER_GAME:
+                is_participant = self.add_participant(chat_id, user_id, username, first_name)
+
+            participants = self.get_registered_participants(chat_id)
+            if not is_participant:
+                return TurnContext(game_info.status, game_info.difficulty, False, participants)
+
+            self.add_participant_message(chat_id, user_id, username, first_name, message)
+            return TurnContext(
+                game_info.status, game_info.difficulty, True, participants,
+                self.get_participant_message_count(chat_id, user_id),
+                self.get_participants_stats(chat_id),
+                self.get_conversation_history(chat_id, history_limit)
+            )
+
+    def add_participant_message(self, chat_id: int, user_id: int, username: str, first_name: str, message: str):
+        timestamp = now_ms()
+        with self._lock:
+            self._messages.setdefault(chat_id, []).append(
+                ParticipantMessage(user_id, username or "", first_name or "Аноним", message, timestamp)
+            )
+            participant = self._participants.get(chat_id, {}).get(user_id)
+            if participant:
+                participant['message_count'] += 1
+                participant['last_message_at'] = timestamp
+                participant['total_chars'] += len(message)
+
+    def get_participant_message_count(self, chat_id: int, user_id: int) -> int:
+        with self._lock:
+            participant = self._participants.get(chat_id, {}).get(user_id)
+            return participant['message_count'] if participant else 0
+
+    def get_participant_messages(self, chat_id: int, user_id: Optional[int] = None) -> List[ParticipantMessage]:
+        with self._lock:
+            return [m for m in self._messages.get(chat_id, []) if not user_id or m.user_id == user_id]
+
+    def get_recent_messages_per_participant(self, chat_id: int, per_user: int) -> List[ParticipantMessage]:
+        with self._lock:
+            by_user: Dict[int, List[ParticipantMessage]] = {}
+            for m in self._messages.get(chat_id, []):
+                by_user.setdefault(m.user_id, []).append(m)
+            return [
+                m for user_id in sorted(by_user)
+                for m in by_user[user_id][max(len(by_user[user_id]) - per_user, 0):]
+            ]
+
+    def get_participants_stats(self, chat_id: int) -> List[Participant]:
+        with self._lock:
+            stats = [
+                self._participant_record(p)
+                for p in self._participants.get(chat_id, {}).values() if p['message_count'] > 0
+            ]
+        return sorted(stats, key=lambda s: s.message_count, reverse=True)
+
+    def add_affection(self, chat_id: int, user_id: int, delta: int):
+        with self._lock:
+            participant = self._participants.get(chat_id, {}).get(user_id)
+            if participant:
+                participant['affection'] += delta
+
+    def get_affection_scores(self, chat_id: int) -> List[AffectionScore]:
+        with self._lock:
+            scores = [
+                AffectionScore(p['user_id'], p['username'], p['first_name'], p['affection'])
+                for p in self._participants.get(chat_id, {}).values()
+            ]
+        return sorted(scores, key=lambda s: s.affection, reverse=True)
+
+    def get_last_message_time(self, chat_id: int) -> Optional[int]:
+        with self._lock:
+            messages = self._messages.get(chat_id)
+            if messages:
+                return messages[-1].timestamp
+            return self.get_game_start_time(chat_id)
+
+    def add_conversation(self, chat_id: int, role: str, content: str):
+        with self._lock:
+            history = self._conversation.get(chat_id)
+            if history is None:
+                history = self._conversation[chat_id] = deque(maxlen=config.CONVERSATION_WINDOW)
+            if len(history) == history.maxlen:
+                self._evicted_conversation.setdefault(chat_id, []).append(history[0])
+            history.append(ConversationTurn(role, content, now_ms()))
+
+    def get_conversation_history(self, chat_id: int, limit: Optional[int] = None) -> List[ConversationTurn]:
+        with self._lock:
+            turns = list(self._conversation.get(chat_id, []))
+        if limit is not None:
+            turns = turns[max(len(turns) - limit, 0):]
+        return turns
+
+    def get_storage_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'active_games': sum(1 for s in self._sessions.values() if s['is_active'] == 1),
+                'live_messages': sum(len(m) for m in self._messages.values()),
+                'live_conversation': sum(len(c) for c in self._conversation.values()),
+                'archived_games': len(self._archive)
+            }
+
+    def prune_archive(self, retention_days: int, vacuum_pages: int) -> int:
+        cutoff = now_ms() - retention_days * 86400 * 1000
+        with self._lock:
+            kept = [game for game in self._archive if game['ended_at'] >= cutoff]
+            pruned = len(self._archive) - len(kept)
+            self._archive = kept
+        return pruned
+
+
+def create_storage(backend: Optional[str] = None) -> StorageBackend:
+    """Создать движок хранилища по имени (по умолчанию config.STORAGE_BACKEND)"""
+    backend = backend or config.STORAGE_BACKEND
+    if backend == "sqlite":
+        from database import Database
+        return Database()
+    if backend == "sharded":
+        from database import ShardedDatabase
+        return ShardedDatabase(config.DB_SHARDS)
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")